@@ -1,8 +1,14 @@
 #!python2.7
 import os,sys
+import multiprocessing
 
 # Set up basic paths to find pandoc, nodejs, etc.
 os.environ['PATH'] = os.pathsep.join(['/usr/local/bin/','/usr/bin','/bin', os.environ.get('PATH','')])
-    
-from pathomx import Pathomx
-Pathomx.main()
\ No newline at end of file
+
+# Guarded, as worker processes (see pathomx.backends.ProcessBackend) import this script on
+# Windows and in frozen builds; they must not start another copy of the GUI
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    from pathomx import Pathomx
+    Pathomx.main()
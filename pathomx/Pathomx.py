@@ -40,6 +40,7 @@ except ImportError:
 
 import requests
 import time
+import multiprocessing
 
 from .globals import styles, notebook_queue, \
                      current_tools, current_tools_by_id, installed_plugin_names, current_datasets, \
@@ -49,11 +50,14 @@ from .globals import styles, notebook_queue, \
 from . import utils
 from . import ui
 from . import plugins  # plugin helper/manager
+from . import resultstore
+from . import workflow
 from .editor.editor import WorkspaceEditorView  # EDITOR_MODE_NORMAL, EDITOR_MODE_TEXT, EDITOR_MODE_REGION
 
 # Translation (@default context)
 from .translate import tr
 from .runqueue import ExecuteOnly
+from .backends import BACKEND_NAMES
 
 from distutils.version import StrictVersion
 
@@ -257,6 +261,12 @@ class MainWindow(QMainWindow):
         saveAsAction.setStatusTip(tr('Save current workflow for future use'))
         saveAsAction.triggered.connect(self.onSaveWorkflowAs)
         self.menuBars['file'].addAction(saveAsAction)
+
+        save_resultsAction = QAction(tr('Save Results With Workflow'), self)
+        save_resultsAction.setStatusTip(tr('Save tool results alongside the workflow, so it opens without recalculating'))
+        save_resultsAction.setCheckable(True)
+        settings.add_handler('Workflow/Save_results', save_resultsAction)
+        self.menuBars['file'].addAction(save_resultsAction)
         #self.menuBars['file'].addSeparator()
 
         export_ipythonnbAction = QAction(QIcon(os.path.join(utils.scriptdir, 'icons', 'ipython.png')), 'Export IPython notebook…', self)
@@ -561,11 +571,23 @@ class MainWindow(QMainWindow):
         export_reportAction.triggered.connect(self.onExportReport)
         #t.addAction(export_reportAction)
 
+        cancel_jobsAction = QAction(QIcon(os.path.join(utils.scriptdir, 'icons', 'cross.png')), 'Cancel all calculations', self)
+        cancel_jobsAction.setStatusTip('Stop all running and queued calculations')
+        cancel_jobsAction.triggered.connect(self.onCancelJobs)
+        t.addAction(cancel_jobsAction)
+
         interrupt_kernelsAction = QAction(QIcon(os.path.join(utils.scriptdir, 'icons', 'server--exclamation.png')), 'Restart cluster…', self)
         interrupt_kernelsAction.setStatusTip('Interrupt kernel(s), stop processing and restart cluster')
         interrupt_kernelsAction.triggered.connect(self.onInterruptKernels)
         t.addAction(interrupt_kernelsAction)
 
+        backendcb = QComboBox()
+        backendcb.addItems(list(BACKEND_NAMES.keys()))
+        backendcb.setStatusTip('Where tools are run: IPython cluster engines or worker processes (restarts the cluster)')
+        settings.add_handler('Runner/Backend', backendcb, BACKEND_NAMES)
+        backendcb.currentIndexChanged.connect(self.onChangeBackend)
+        t.addWidget(backendcb)
+
     def addEditorToolBar(self):
         t = self.addToolBar('Editor')
         t.setIconSize(QSize(16, 16))
@@ -723,6 +745,8 @@ class MainWindow(QMainWindow):
         self.kernelStatus.update(notebook_queue)
         #self.threadCount.setText('%d' % (notebook_queue.no_of_active_runners, notebook_queue.no_of_runners))
         self.jobQueue.setText('%d' % len(notebook_queue.jobs))
+        self.jobQueue.setToolTip(tr('%d jobs (%d tasks) queued; longest wait %.0fs, typical wait %.1fs') % (
+            len(notebook_queue.jobs), notebook_queue.no_of_tasks_queued, notebook_queue.longest_wait, notebook_queue.wait_time))
 
     def onDoRegister(self):
         # Pop-up a registration window; take an email address and submit to
@@ -957,6 +981,9 @@ class MainWindow(QMainWindow):
         tree = et.ElementTree(root)
         tree.write(fn)  # , pretty_print=True)
 
+        if utils.setting_bool(settings.get('Workflow/Save_results')):
+            resultstore.save(fn, current_tools)
+
     def onOpenWorkflow(self):
         """ Open a data file"""
         filename, _ = QFileDialog.getOpenFileName(self, 'Open new workflow', '', "Pathomx Workflow Format (*.mpf)")
@@ -968,53 +995,32 @@ class MainWindow(QMainWindow):
         # Wipe existing workspace
         self.clearWorkspace()
         # Load from file
-        tree = et.parse(fn)
-        workflow = tree.getroot()
+        root = workflow.parse(fn)
 
-        s = workflow.find('Styles')
+        s = root.find('Styles')
         if s is not None:
             styles.setXMLMatchDefinitionsStyles(s)
 
-        a = workflow.find('Annotations')
+        a = root.find('Annotations')
         if a is not None:
             self.editor.setXMLAnnotations(a)
 
-        appref = {}
-        logging.info("...Loading apps.")
-        for xapp in workflow.findall('App'):
-            # FIXME: This does not work with multiple launchers/plugin - define as plugin.class?
-            # Check plugins loaded etc.
-            logging.info(('- %s' % xapp.find('Name').text))
-
-            xcode = xapp.find('Code')
-            if xcode is not None:
-                code = xcode.text
-            else:
-                code = ""
-
-            app = app_launchers["%s.%s" % (xapp.find("Plugin").text, xapp.find("Launcher").text)](self, code=code, auto_consume_data=False, name=xapp.find('Name').text)
+        def launch(launcher, xapp, **kwargs):
+            app = launcher(self, auto_consume_data=False, **kwargs)
             editorxy = xapp.find('EditorXY')
             app.editorItem.setPos(QPointF(float(editorxy.get('x')), float(editorxy.get('y'))))
-            appref[xapp.get('id')] = app
-
-            app.config.setXMLConfig(xapp)
-
-        logging.info("...Linking objects.")
-        # Now build the links between objects; we need to force these as data is not present
-        for xapp in workflow.findall('App'):
-            app = appref[xapp.get('id')]
+            return app
 
-            for idef in xapp.findall('DataInputs/Input'):
-                source_app = appref[idef.get('manager')]
-                source = idef.get('interface')
-                if source in source_app.legacy_outputs.keys():
-                    source = source_app.legacy_outputs[source]
+        appref = workflow.create_tools(root, launch)
 
-                sink = idef.get('id')
-                if sink in app.legacy_inputs.keys():
-                    sink = app.legacy_inputs[sink]
+        # The default code is otherwise only loaded once the tool is shown (init_notebook),
+        # and is needed to match the saved results
+        for app in appref.values():
+            app.load_source()
 
-                app.data._consume_action(source_app.data, source, sink)
+        # Restore saved results that are still valid for the current code/config
+        for app, (key, varso) in resultstore.load(fn, appref).items():
+            app.restore_result(key, varso)
 
         logging.info("Load complete.")
         # Focus the home tab & refresh the view
@@ -1148,6 +1154,14 @@ class MainWindow(QMainWindow):
     def onInterruptKernels(self):
         notebook_queue.restart()
 
+    def onChangeBackend(self):
+        if notebook_queue.backend_name != settings.get('Runner/Backend'):
+            notebook_queue.backend_name = settings.get('Runner/Backend')
+            notebook_queue.restart()
+
+    def onCancelJobs(self):
+        notebook_queue.interrupt()
+
 #class QApplicationExtend(QApplication):
     #def event(self, e):
     #    if e.type() == QEvent.FileOpen:
@@ -1164,6 +1178,8 @@ class MainWindow(QMainWindow):
     #        return super(QApplicationExtend, self).event(e)
 
 def main():
+    # Worker processes (see backends.ProcessBackend) in frozen builds start here
+    multiprocessing.freeze_support()
 
     logging.debug('Setting up localisation...')
 
@@ -1220,6 +1236,6 @@ def main():
     logging.info('Ready.')
     app.exec_()  # Enter Qt application main loop
 
-    notebook_queue.stop_cluster()
+    notebook_queue.shutdown()
 
     logging.info('Exiting.')
@@ -0,0 +1,565 @@
+from __future__ import unicode_literals
+import os
+import sys
+import time
+import logging
+import multiprocessing
+
+from .qt import *
+
+from IPython.parallel import Client, RemoteError
+from IPython.utils.pickleutil import use_dill
+from IPython.parallel.apps import ipclusterapp
+
+import zmq
+
+from subprocess import Popen
+from collections import OrderedDict
+
+from . import transport
+from .kernel_helpers import worker_main
+
+# Execution backends for the Queue (see runqueue.Queue)
+#
+# A backend starts and stops the processes that tools are run on, and provides a kernel object
+# for each, which is wrapped by a Runner. Kernels hold the variables set on them between calls,
+# so tool data stays where it was calculated; runqueue identifies kernels by id(kernel).
+#
+# Kernels provide:
+#   apply_async(f, *args)   - call f(*args) on the kernel, returning a result handle
+#   is_done(ar)             - True once the result (or error) has been received
+#   get(ar)                 - the return value of f; raises TaskError if f raised
+#   stdout(ar)              - everything written to stdout by f so far
+#   data(ar)                - the latest data published by f (see kernel_helpers.publish)
+#   wall_time(ar)           - time taken from submission to result (seconds)
+#   abort(ar)               - discard the result; True if f may still be running
+#   pid                     - process id (for memory use and interrupts), or None if not yet known
+#   name                    - for display
+#
+# The backend emits activity whenever messages are received from any of its kernels.
+#
+#   cluster  - IPython.parallel engines, started with ipcluster
+#   process  - worker processes started directly with multiprocessing (no ipcluster)
+#
+# The backend is chosen with the Runner/Backend setting; in the GUI from the File toolbar
+# (which restarts the cluster), for pathomx-batch with --backend.
+
+
+class TaskError(Exception):
+    """
+    Raised by get() when the function applied on a kernel raised an exception; the formatted
+    (remote) traceback is held in traceback
+    """
+
+    def __init__(self, traceback):
+        super(TaskError, self).__init__(traceback)
+        self.traceback = traceback
+
+
+class Backend(QObject):
+    """
+    Base class for execution backends
+    """
+
+    activity = pyqtSignal()
+
+    def start(self, n):
+        """
+        Start n kernels
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        """
+        Stop all kernels
+        """
+        raise NotImplementedError
+
+    def is_alive(self):
+        """
+        False if the backend has failed (and must be restarted)
+        """
+        return True
+
+    def kernels(self):
+        """
+        Return the list of running kernels, or None if the backend is not yet ready
+        """
+        raise NotImplementedError
+
+    def start_engines(self, n):
+        """
+        Start n additional kernels; these are returned by kernels() once ready
+        """
+        raise NotImplementedError
+
+    def stop_engine(self, kernel):
+        """
+        Stop the given kernel, which is no longer returned by kernels()
+        """
+        raise NotImplementedError
+
+    def spin(self):
+        """
+        Collect any waiting messages from the kernels
+        """
+        pass
+
+    def queue_status(self):
+        """
+        Return a dict of kernel: number of messages queued on it (by anyone) where known
+        """
+        return {}
+
+
+class ClusterKernel(object):
+    """
+    Kernel on an IPython.parallel engine; wraps a DirectView on the engine
+    """
+
+    def __init__(self, view):
+        self.view = view
+        self.client = view.client
+        self.targets = view.targets
+        self.name = 'engine %s' % view.targets
+
+        self._pid = None
+        self._pid_ar = self.view.apply_async(os.getpid)
+
+    def setup(self):
+        self.view.execute('%reset -f')
+        self.view.execute('%matplotlib inline')
+        self.view.apply(use_dill)
+        self.view.apply(transport.register)
+
+    def apply_async(self, f, *args):
+        return self.view.apply_async(f, *args)
+
+    def is_done(self, ar):
+        # The client is spun by the listener, so we can check the outstanding set without a round trip
+        return not (self.client.outstanding & set(ar.msg_ids))
+
+    def get(self, ar):
+        try:
+            return ar.get(0)
+        except RemoteError as e:
+            raise TaskError('\n'.join(e.render_traceback()))
+
+    def stdout(self, ar):
+        return ar.stdout
+
+    def data(self, ar):
+        return ar.data
+
+    def wall_time(self, ar):
+        return ar.wall_time
+
+    def abort(self, ar):
+        msg_ids = list(self.client.outstanding & set(ar.msg_ids))
+        if not msg_ids:
+            return False
+
+        try:
+            self.client.abort(jobs=msg_ids, targets=self.targets, block=False)
+        except Exception as e:
+            logging.warning("Could not abort queued messages on kernel: %s" % e)
+        return True
+
+    @property
+    def pid(self):
+        if self._pid is None and self._pid_ar is not None and self.is_done(self._pid_ar):
+            try:
+                self._pid = self._pid_ar.get(0)
+            except Exception as e:
+                logging.warning("Could not get process id of kernel: %s" % e)
+            self._pid_ar = None
+
+        return self._pid
+
+
+class ClientListener(QObject):
+    """
+    Watches the sockets of an IPython.parallel Client from the Qt event loop
+
+    The zmq sockets the Client receives results, stdout and engine registration
+    notifications on each expose a file descriptor that becomes readable when messages
+    arrive. A QSocketNotifier on each triggers a spin of the client (to collect the
+    messages) and the activity signal, so that results are handled as soon as they
+    arrive and no time is spent checking while the cluster is idle.
+    """
+
+    activity = pyqtSignal()
+
+    socket_names = ['_mux_socket', '_task_socket', '_iopub_socket', '_control_socket', '_notification_socket']
+
+    def __init__(self, client, *args, **kwargs):
+        super(ClientListener, self).__init__(*args, **kwargs)
+
+        self.client = client
+        self.sockets = [getattr(client, n) for n in self.socket_names if getattr(client, n, None) is not None]
+
+        self.notifiers = []
+        for s in self.sockets:
+            n = QSocketNotifier(s.getsockopt(zmq.FD), QSocketNotifier.Read, self)
+            n.activated.connect(self.on_activated)
+            self.notifiers.append(n)
+
+    def has_messages(self):
+        return any(s.getsockopt(zmq.EVENTS) & zmq.POLLIN for s in self.sockets)
+
+    def on_activated(self, fd=None):
+        # zmq file descriptors are edge-triggered; we must drain everything waiting
+        # before returning to the event loop or we will not be notified again
+        for n in self.notifiers:
+            n.setEnabled(False)
+
+        try:
+            self.client.spin()
+            while self.has_messages():
+                self.client.spin()
+
+        finally:
+            for n in self.notifiers:
+                n.setEnabled(True)
+
+        self.activity.emit()
+
+    def close(self):
+        for n in self.notifiers:
+            n.setEnabled(False)
+            n.deleteLater()
+        self.notifiers = []
+
+
+class ClusterBackend(Backend):
+    """
+    Run tools on IPython.parallel engines, started with ipcluster
+
+    The cluster takes a few seconds to start; the client connects on the first check
+    of kernels() after that. Engines may be added (ipcluster engines) and shut down
+    individually while the cluster is running.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ClusterBackend, self).__init__(*args, **kwargs)
+
+        self.p = None
+        self.client = None
+        self.listener = None
+
+        # Kernels by engine id, so each engine is always represented by the same object
+        self._kernels = {}
+        # Processes running additional engines (see start_engines)
+        self.engine_processes = []
+        # Engines being shut down, which may still be registered with the client
+        self.detached_targets = set()
+
+    def start(self, n):
+        self.p = Popen([sys.executable, ipclusterapp.__file__, 'start', '--n=%d' % n], stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+
+    def stop(self):
+        # Stop the ipcluster
+        p = Popen([sys.executable, ipclusterapp.__file__, 'stop'], stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+        while p.poll() is None:  # Wait for the above to exit
+            pass
+
+        self.p = None
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+
+        if self.client:
+            self.client.shutdown()
+            self.client = None
+
+        for p in self.engine_processes:
+            if p.poll() is None:
+                p.terminate()
+        self.engine_processes = []
+        self._kernels = {}
+        self.detached_targets = set()
+
+    def terminate(self):
+        if self.p:
+            self.p.terminate()
+            self.p = None
+
+    def is_alive(self):
+        return self.p is not None and self.p.poll() is None
+
+    def kernels(self):
+        if self.client is None:
+            try:
+                self.client = Client(timeout=5)
+            except Exception as e:
+                logging.debug("Could not connect to cluster: %s" % e)
+                return None
+
+            self.listener = ClientListener(self.client)
+            self.listener.activity.connect(self.activity.emit)
+
+        # Engines that have gone (or been stopped) are no longer registered
+        ids = set(self.client.ids)
+        self.detached_targets &= ids
+        for target in list(self._kernels.keys()):
+            if target not in ids:
+                del self._kernels[target]
+
+        for target in ids - self.detached_targets:
+            if target not in self._kernels:
+                k = ClusterKernel(self.client[target])
+                k.setup()
+                self._kernels[target] = k
+
+        return [self._kernels[t] for t in sorted(self._kernels.keys()) if t not in self.detached_targets]
+
+    def start_engines(self, n):
+        # Additional engines register with the running cluster (and are picked up by kernels)
+        p = Popen([sys.executable, ipclusterapp.__file__, 'engines', '--n=%d' % n], stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+        self.engine_processes.append(p)
+
+    def stop_engine(self, kernel):
+        self.detached_targets.add(kernel.targets)
+        try:
+            self.client.shutdown(targets=kernel.targets, block=False)
+        except Exception as e:
+            logging.warning("Could not stop engine %s: %s" % (kernel.targets, e))
+
+    def spin(self):
+        if self.client is not None:
+            self.client.spin()
+
+    def queue_status(self):
+        if self.client is None:
+            return {}
+
+        try:
+            queue_status = self.client.queue_status()
+        except Exception:
+            return {}
+
+        return {k: queue_status[t]['queue'] for t, k in self._kernels.items() if t in queue_status}
+
+
+class ProcessResult(object):
+    """
+    Result handle for a call on a ProcessKernel
+    """
+
+    def __init__(self, msg_id):
+        self.msg_id = msg_id
+        self.submitted = time.time()
+        self.completed = None
+        self._stdout = []
+        self.data = {}
+        self.value = None
+        self.error = None
+        self.aborted = False
+
+    @property
+    def done(self):
+        return self.completed is not None
+
+    @property
+    def stdout(self):
+        return ''.join(self._stdout)
+
+
+class ProcessKernel(object):
+    """
+    Kernel on a worker process (see kernel_helpers.worker_main), connected by a pipe
+
+    Calls are sent to the worker as they are made and run there in turn. Replies are
+    collected by receive(), which is triggered by the backend when the pipe is readable.
+    """
+
+    def __init__(self, n):
+        self.name = 'worker %d' % n
+
+        self.conn, worker_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_main, args=(worker_conn,))
+        self.process.daemon = True
+        self.process.start()
+        worker_conn.close()
+
+        self.results = {}  # Outstanding, by msg_id
+        self._msg_seq = 0
+        self.closed = False
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def apply_async(self, f, *args):
+        ar = ProcessResult(self._msg_seq)
+        self._msg_seq += 1
+
+        self.results[ar.msg_id] = ar
+        self.conn.send((ar.msg_id, f, args))
+        return ar
+
+    def receive(self):
+        """
+        Collect all waiting replies; returns True if any were received
+        """
+        if self.closed:
+            return False
+
+        received = False
+        try:
+            while self.conn.poll():
+                kind, msg_id, value = self.conn.recv()
+                received = True
+
+                ar = self.results.get(msg_id)
+                if ar is None:
+                    continue
+
+                if kind == 'stdout':
+                    ar._stdout.append(value)
+                    continue
+
+                if kind == 'data':
+                    ar.data.update(value)
+                    continue
+
+                if kind == 'result':
+                    ar.value = value
+                else:
+                    ar.error = value
+                ar.completed = time.time()
+                del self.results[msg_id]
+
+        except (EOFError, IOError, OSError):
+            # The worker has gone; nothing outstanding will complete
+            self.closed = True
+            self.fail("Worker process %s stopped" % self.name)
+            received = True
+
+        return received
+
+    def fail(self, error):
+        for ar in self.results.values():
+            ar.error = error
+            ar.completed = time.time()
+        self.results = {}
+
+    def is_done(self, ar):
+        return ar.done
+
+    def get(self, ar):
+        if ar.error is not None:
+            raise TaskError(ar.error)
+        return ar.value
+
+    def stdout(self, ar):
+        return ar.stdout
+
+    def data(self, ar):
+        return ar.data
+
+    def wall_time(self, ar):
+        return (ar.completed or time.time()) - ar.submitted
+
+    def abort(self, ar):
+        # Calls cannot be withdrawn once sent; the reply is discarded on arrival
+        ar.aborted = True
+        self.results.pop(ar.msg_id, None)
+        return not ar.done
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+        self.conn.close()
+        self.closed = True
+        self.fail("Worker process %s stopped" % self.name)
+
+
+class ProcessBackend(Backend):
+    """
+    Run tools on worker processes started directly (multiprocessing), without ipcluster
+
+    Each worker is a persistent process with its own namespace, so tool data stays on the worker
+    it was calculated on, as on a cluster engine. Workers start immediately and are available on
+    the next check. Replies are collected when the pipe to a worker becomes readable (polled by the
+    Queue watchdog on Windows, where pipes cannot be watched).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ProcessBackend, self).__init__(*args, **kwargs)
+        self._kernels = []
+        self._notifiers = {}
+        self._seq = 0
+
+    def start(self, n):
+        self.start_engines(n)
+
+    def stop(self):
+        for k in self._kernels[:]:
+            self.stop_engine(k)
+
+    def kernels(self):
+        # Workers that have died are dropped (their calls fail on receive)
+        for k in self._kernels[:]:
+            if not k.is_alive():
+                k.receive()
+                self.stop_engine(k)
+
+        return self._kernels[:]
+
+    def start_engines(self, n):
+        for _ in range(n):
+            k = ProcessKernel(self._seq)
+            self._seq += 1
+            self._kernels.append(k)
+
+            if os.name != 'nt':
+                notifier = QSocketNotifier(k.conn.fileno(), QSocketNotifier.Read, self)
+                notifier.activated.connect(lambda fd, k=k: self.on_activated(k))
+                self._notifiers[k] = notifier
+
+    def stop_engine(self, kernel):
+        if kernel in self._kernels:
+            self._kernels.remove(kernel)
+
+        notifier = self._notifiers.pop(kernel, None)
+        if notifier:
+            notifier.setEnabled(False)
+            notifier.deleteLater()
+
+        kernel.stop()
+
+    def on_activated(self, kernel):
+        received = kernel.receive()
+        if kernel.closed:
+            # The pipe stays readable once closed; the worker is dropped on the next check
+            self._notifiers[kernel].setEnabled(False)
+
+        if received:
+            self.activity.emit()
+
+    def spin(self):
+        for k in self._kernels:
+            k.receive()
+
+
+BACKENDS = {
+    'cluster': ClusterBackend,
+    'process': ProcessBackend,
+}
+
+# Display names of the backends, for the Runner/Backend setting
+BACKEND_NAMES = OrderedDict([
+    ('IPython cluster', 'cluster'),
+    ('Worker processes', 'process'),
+])
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+import sys
+import re
+import time
+import logging
+import argparse
+
+# Tools are created with their (hidden) widgets, so run Qt without a display
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from .qt import *
+
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+
+from .globals import notebook_queue
+from . import plugins
+from . import resultstore
+from . import transport
+from . import displayobjects
+from . import workflow
+from .runqueue import ToolJob, PRIORITY_BATCH
+from .backends import BACKENDS
+
+# Headless batch runner for workflows (.mpf)
+#
+#   pathomx-batch workflow.mpf [workflow.mpf ...] --output results/
+#
+# Each workflow is loaded (as for MainWindow.openWorkflow) and run as a single job from all
+# of its tools without inputs, at batch priority. The outputs of each tool are then written to
+# <output>/<workflow>/<tool id>_<tool name>/<output>.<ext>: DataFrame/Series as .csv, arrays
+# as .npy, figures as .png and anything else pickled. Saved results (see resultstore) that
+# are still valid are used, as in the GUI, unless --recalculate is given.
+
+POLL_INTERVAL = 500  # ms
+
+
+class BatchEditor(object):
+    """
+    Stands in for the workflow editor; tools are never drawn
+    """
+
+    class Item(object):
+        def setPos(self, *args):
+            pass
+
+    def addApp(self, app, position=None):
+        return BatchEditor.Item()
+
+    def removeApp(self, app):
+        pass
+
+
+class BatchWorkspace(QWidget):
+    """
+    Stands in for the main window as the parent of the tools of a workflow
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BatchWorkspace, self).__init__(*args, **kwargs)
+        self.editor = BatchEditor()
+
+    def register_url_handler(self, identifier, url_handler):
+        pass
+
+    def onBrowserNav(self, url):
+        pass
+
+
+def safe_filename(s):
+    return re.sub(r'[^\w\-\.]+', '_', s).strip('_')
+
+
+def write_output(obj, path, name):
+    """
+    Write a single tool output to path, in a format depending on the type. Returns the filename
+    """
+    obj = transport.resolve(obj)
+
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        fn = '%s.csv' % name
+        obj.to_csv(os.path.join(path, fn))
+
+    elif isinstance(obj, np.ndarray):
+        fn = '%s.npy' % name
+        np.save(os.path.join(path, fn), obj)
+
+    elif isinstance(obj, displayobjects.RenderedFigure):
+        fn = '%s.png' % name
+        with open(os.path.join(path, fn), 'wb') as f:
+            f.write(obj.png)
+
+    elif isinstance(obj, Figure):
+        fn = '%s.png' % name
+        obj.savefig(os.path.join(path, fn))
+
+    else:
+        fn = transport.dump(obj, path, name)
+
+    return fn
+
+
+def write_outputs(tool, path):
+    """
+    Write the outputs of the tool's latest result to path; returns the number written
+    """
+    varso = tool._latest_generator_result
+    if not varso:
+        return 0
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    n = 0
+    for k, v in varso.items():
+        if v is None or k == 'styles':
+            continue
+
+        try:
+            write_output(v, path, safe_filename(k))
+            n += 1
+        except Exception as e:
+            logging.warning("Could not write output '%s' of %s: %s" % (k, tool.name, e))
+
+    return n
+
+
+class BatchRunner(QObject):
+    """
+    Run each workflow in turn; quitting the application when all are complete
+
+    Completion of each workflow is detected by polling the queue, as results are delivered
+    to the tools on the event loop.
+    """
+
+    def __init__(self, workflows, output, recalculate=False, timeout=None, *args, **kwargs):
+        super(BatchRunner, self).__init__(*args, **kwargs)
+        self.workflows = list(workflows)
+        self.output = output
+        self.recalculate = recalculate
+        self.timeout = timeout
+
+        self.workspace = BatchWorkspace()
+        self.fn = None
+        self.tools = {}
+        self.status = {}
+        self.started = None
+        self.failed = []
+
+        self._poll_timer = QTimer()
+        self._poll_timer.timeout.connect(self.poll)
+
+    def start(self):
+        self.next_workflow()
+        self._poll_timer.start(POLL_INTERVAL)
+
+    def next_workflow(self):
+        while self.workflows:
+            fn = self.workflows.pop(0)
+            try:
+                self.load(fn)
+            except Exception as e:
+                logging.error("Could not load workflow %s: %s" % (fn, e))
+                self.failed.append(fn)
+                continue
+
+            self.fn = fn
+            self.run()
+            return
+
+        self.fn = None
+        self._poll_timer.stop()
+        notebook_queue.shutdown()
+        QApplication.exit(1 if self.failed else 0)
+
+    def load(self, fn):
+        logging.info("Loading workflow... %s" % fn)
+
+        def launch(launcher, xapp, **kwargs):
+            return launcher(self.workspace, auto_consume_data=False, **kwargs)
+
+        self.tools = workflow.create_tools(workflow.parse(fn), launch)
+        self.status = {}
+        for t in self.tools.values():
+            # Normally loaded once the tool is shown
+            t.load_source()
+            t.status.connect(lambda s, t=t: self.status.__setitem__(t, s))
+
+        if not self.recalculate:
+            for app, (key, varso) in resultstore.load(fn, self.tools).items():
+                app.restore_result(key, varso)
+
+    def run(self):
+        # Start from all tools without inputs; everything downstream follows
+        roots = [t for t in self.tools.values() if not t.get_parents()]
+        logging.info("Running %d tools from %d inputs" % (len(self.tools), len(roots)))
+
+        self.started = time.time()
+        if roots:
+            for t in roots:
+                t.status.emit('active')
+            notebook_queue.add(ToolJob(roots, roots[0].get_global_varsi(), priority=PRIORITY_BATCH))
+
+    def poll(self):
+        if self.fn is None:
+            return
+
+        if notebook_queue.active_jobs():
+            if self.timeout and time.time() - self.started > self.timeout:
+                logging.error("Timed out running %s" % self.fn)
+                notebook_queue.interrupt()
+            return
+
+        self.complete()
+        self.next_workflow()
+
+    def complete(self):
+        name = safe_filename(os.path.splitext(os.path.basename(self.fn))[0])
+        errors = [t for t in self.tools.values() if self.status.get(t) != 'done']
+
+        for i, t in self.tools.items():
+            path = os.path.join(self.output, name, '%s_%s' % (safe_filename(i), safe_filename(t.name)))
+            write_outputs(t, path)
+
+        for t in errors:
+            logging.error("%s: %s" % (t.name, self.status.get(t, 'not run')))
+
+        if errors:
+            self.failed.append(self.fn)
+
+        logging.info("Completed %s in %.1fs (%d errors)" % (self.fn, time.time() - self.started, len(errors)))
+
+        for t in list(self.tools.values()):
+            t.delete()
+        self.tools = {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run Pathomx workflows without the GUI, writing the tool outputs to disk.')
+    parser.add_argument('workflows', nargs='+', help='workflow (.mpf) files to run')
+    parser.add_argument('-o', '--output', default='.', help='folder to write outputs to (default: current folder)')
+    parser.add_argument('-e', '--engines', type=int, default=None, help='number of engines to run (default: from settings)')
+    parser.add_argument('-b', '--backend', choices=sorted(BACKENDS.keys()), default=None, help='execution backend (default: from settings)')
+    parser.add_argument('-t', '--timeout', type=float, default=None, help='maximum time to run each workflow (seconds)')
+    parser.add_argument('--recalculate', action='store_true', help='ignore results saved alongside the workflows')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.engines is not None:
+        notebook_queue.max_engines = args.engines
+
+    if args.backend is not None:
+        notebook_queue.backend_name = args.backend
+
+    plugins.get_available_plugins()
+
+    notebook_queue.create_runners()
+    notebook_queue.start_timers()
+
+    runner = BatchRunner(args.workflows, args.output, recalculate=args.recalculate, timeout=args.timeout)
+    QTimer.singleShot(0, runner.start)
+
+    sys.exit(app.exec_())
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,6 @@ logging.debug('Loading data.py')
 from .qt import *
 
 from collections import defaultdict
-from copy import deepcopy
 
 import operator
 import logging
@@ -18,6 +17,8 @@ import pandas as pd
 import numpy as np
 from PIL import Image
 
+from . import transport
+
 class DataTreeItem(object):
     '''
     a python object used to return row/column data, and keep note of
@@ -208,14 +209,16 @@ class DataManager(QObject):
         self.watchers = defaultdict(set)  # List of watchers on each output interface
 
     # Get a dataset through input interface id;
-    # This provides indirect access to a copy of the object (local link in self.i = {})
+    # This provides indirect access to a read-only view of the object (local link in self.i = {})
+    # or a copy where a view is not possible (see transport.read_only)
     def get(self, interface):
         if interface in self.i and self.i[interface] is not None:
             # Add ourselves to the watcher for this interface
             source_manager, source_interface = self.i[interface]
-            data = source_manager.o[source_interface]
+            # Load data held in the shared store (see transport.DataProxy)
+            data = transport.resolve(source_manager.o[source_interface])
             #dso.manager.watchers[ dso.manager_interface ].add( self )
-            return deepcopy(data)
+            return transport.read_only(data)
 
         return None
 
@@ -224,6 +227,14 @@ class DataManager(QObject):
             self._unconsume(interface)
             self.i[interface] = None
 
+    # Get a dataset through input interface id, as held by the source (not loaded or copied)
+    def geti(self, interface):
+        if interface in self.i and self.i[interface] is not None:
+            source_manager, source_interface = self.i[interface]
+            return source_manager.o[source_interface]
+
+        return None
+
     # Output a dataset through output interface id
     # Advertise object for consumption; needs to handle notification of all consumers
     # independent of the object itself (so can overwrite instead of warping)
@@ -465,7 +476,7 @@ class NumpyArrayDataDefinition(DataDefinition):
                self._check_dimensionality(o)
 
     def _check_instance(self, o):
-        return isinstance(o, np.ndarray)
+        return issubclass(transport.data_type(o), np.ndarray)
 
     def _check_dimensionality(self, o):
         if 'shape' not in self.definition:
@@ -530,7 +541,7 @@ class PandasDataDefinition(NumpyArrayDataDefinition):
 
     def _check_instance(self, o):
         logging.debug("  check instance")
-        return isinstance(o, pd.DataFrame)
+        return issubclass(transport.data_type(o), pd.DataFrame)
 
 
 class ImageDataDefinition(DataDefinition):
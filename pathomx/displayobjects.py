@@ -1,6 +1,8 @@
 import os
 from copy import copy
+from io import BytesIO
 from . import utils
+from . import transport
 from IPython.nbconvert.filters.markdown import markdown2html_mistune
 
 css = os.path.join(utils.scriptdir, 'html', 'css', 'style.css')
@@ -11,6 +13,9 @@ class BaseObj(object):
     def __unicode__(self):
         return self.data
 
+    def __str__(self):
+        return self.data
+
     def __init__(self, data, **kwargs):
         self.data = copy(data)
 
@@ -20,21 +25,44 @@ class Svg(BaseObj):
 
 
 class Html(BaseObj):
+    """
+    HTML content, from a string or an IPython notebook aware object (with _repr_html_)
+
+    Objects are rendered when the HTML is first used; views are generated when they are
+    shown, so objects that are never viewed are never rendered.
+    """
 
     def __init__(self, data, **kwargs):
+        self._source = data
+        self._data = None
 
-        if type(data) == str or type(data) == unicode:
-            html_data = data
+    def __setstate__(self, state):
+        if 'data' in state:  # Saved before rendering was deferred
+            state['_data'] = state.pop('data')
+            state['_source'] = None
+        self.__dict__.update(state)
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.wrap(self._source)
+        return self._data
+
+    @staticmethod
+    def wrap(data):
 
         # Support IPython notebook aware objects
-        elif hasattr(data, '_repr_html_'):
+        if hasattr(data, '_repr_html_'):
             html_data = data._repr_html_()
 
+        else:
+            html_data = data
+
         if '<html' in html_data:
-            self.data = html_data
+            return html_data
         else:
             # Incomplete HTML wrap with the default CSS
-            self.data = '''<html>
+            return '''<html>
 <head><title>About</title><link rel="stylesheet" href="{css}"></head>
 <body>
 <div class="container" id="notebook-container">
@@ -53,3 +81,49 @@ class Markdown(Html):
 
     def __init__(self, data, **kwargs):
         super(Markdown, self).__init__(markdown2html_mistune(data))
+
+
+class RenderedFigure(transport.SharedProxy):
+    """
+    A matplotlib Figure rendered to PNG on the engine
+
+    Pickled figures (e.g. spectra with hundreds of lines) are large and slow to transfer and
+    redraw; the rendered image is shown instead. The Figure itself is held in the shared store
+    and only loaded (load()) when needed, e.g. for interactive zoom/pan or saving.
+    """
+
+    def __init__(self, ref, fig, dpi=100):
+        super(RenderedFigure, self).__init__(ref)
+
+        fc = fig.get_facecolor()
+        if fc == (1, 1, 1, 0):  # Default non-background
+            fc = 'white'
+
+        buf = BytesIO()
+        fig.savefig(buf, format='png', dpi=dpi, facecolor=fc)
+        self.png = buf.getvalue()
+
+        self.size_inches = tuple(fig.get_size_inches())
+        self.dpi = dpi
+
+    def embedded(self):
+        """
+        Return a copy holding the Figure itself, rather than a reference into the shared store
+        (which does not outlive the session); for saving
+        """
+        rf = copy(self)
+        rf.ref = transport.InlineRef(self.load())
+        return rf
+
+    def placeholder(self):
+        """
+        Return a Figure showing the rendered image
+        """
+        from matplotlib.figure import Figure
+        from matplotlib.image import imread
+
+        fig = Figure(figsize=self.size_inches, dpi=self.dpi)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.imshow(imread(BytesIO(self.png), format='png'), interpolation='bilinear')
+        ax.set_axis_off()
+        return fig
@@ -33,6 +33,7 @@ STATUS_COLORS = {
     'waiting': 'yellow',
     'paused': 'white',
     'render': 'purple',
+    'cancelled': 'orange',
     'done': 'blue'
 }
 
@@ -175,6 +176,7 @@ class ToolItem(BaseItem):
         self.progressBar = ToolProgressItem(parent=self)
 
         self.app.progress.connect(self.progressBar.updateProgress)
+        self.app.progress_info.connect(self.progressBar.updateInfo)
         self.app.status.connect(self.progressBar.updateStatus)
 
         self.status_icon = QGraphicsPixmapItem(self)
@@ -530,8 +532,9 @@ class ToolInterface(BaseInteractiveItem):  # QGraphicsPolygonItem):
 
     def get_interface_status(self):
         if self.interface_type == 'input':
+            # Check the source directly; get() would load (and copy) the data
             return (self.app.data.i[self.interface_name] is not None) and \
-                   (self.app.data.get(self.interface_name) is not None)
+                   (self.app.data.geti(self.interface_name) is not None)
 
         elif self.interface_type == 'output':
             return not self.app.data.o[self.interface_name] is None
@@ -762,8 +765,22 @@ class ToolProgressItem(BaseItem):
         self.progress = progress
         self.update()
 
+    def updateInfo(self, info):
+        # Describe the current step (and time remaining) on the tool
+        tip = '%d%%' % (info['progress'] * 100)
+        if info.get('label'):
+            tip = '%s: %s' % (info['label'], tip)
+
+        eta = info.get('eta')
+        if eta is not None:
+            tip += ' (%d:%02d remaining)' % (eta // 60, eta % 60)
+
+        self.parentItem().setToolTip(tip)
+
     def updateStatus(self, status):
         self.status = status
+        if status != 'active':
+            self.parentItem().setToolTip('')
         self.update()
 
     def paint(self, painter, option, widget):
@@ -64,8 +64,25 @@ if not ON_RTD:
         'Editor/Snap_to_grid': False,
         'Editor/Show_grid': True,
         'Editor/Auto_position': False,
+
+        'Workflow/Save_results': False,
+
+        'Runner/Coalesce_interval': 250,  # ms
+        'Runner/Cache_size': 512,  # MB
+        'Runner/Render_figures': True,
+        'Runner/Backend': 'cluster',  # cluster (ipcluster) or process (worker processes)
+        'Runner/Engines': 0,  # 0 = automatic
+        'Runner/Engine_memory_limit': 2048,  # MB; 0 = no limit
+        'Runner/Warm_up': True,
+        'Runner/Warm_up_modules': ['pathomx.kernel_helpers', 'numpy', 'pandas', 'matplotlib.pyplot'],
     })
 
+    notebook_queue.cache.max_size = int(settings.get('Runner/Cache_size')) * 1024 * 1024
+    notebook_queue.render_figures = utils.setting_bool(settings.get('Runner/Render_figures'))
+    notebook_queue.backend_name = settings.get('Runner/Backend')
+    notebook_queue.max_engines = int(settings.get('Runner/Engines'))
+    notebook_queue.engine_memory_limit = int(settings.get('Runner/Engine_memory_limit')) * 1024 * 1024
+
     mono_fontFamilies = {'Windows': 'Courier New',
                     'Darwin': 'Menlo'}
     mono_fontFamily = mono_fontFamilies.get(platform.system(), 'Monospace')
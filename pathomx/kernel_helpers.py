@@ -4,6 +4,10 @@ import numpy as np
 import pandas as pd
 import re
 import io
+import time
+import mmap
+import hashlib
+import linecache
 
 from matplotlib.figure import Figure, AxesStack
 from matplotlib.axes import Subplot
@@ -12,15 +16,14 @@ from mplstyler import StylesManager
 
 import warnings
 from . import displayobjects
+from . import transport
 from .utils import scriptdir, basedir
 from IPython.core import display
 from copy import deepcopy
 
-MAGIC_TYPES = [
-        # Numpy
-        np.array, np.ndarray,
-        # Pandas
-        pd.Series, pd.DataFrame,
+# Types returned as views without being declared by the tool (see pathomx_notebook_stop); data
+# (arrays, DataFrames) and other objects are only returned if declared as outputs or views
+VIEW_TYPES = [
         Figure, Subplot,
         StylesManager,
         # View types
@@ -28,6 +31,24 @@ MAGIC_TYPES = [
         display.SVG
         ]
 
+# IPython extensions providing the magics for non-Python tool languages
+LANGUAGE_EXTENSIONS = {
+    'r': 'rpy2.ipython',
+    'matlab': 'pymatbridge',
+}
+
+# Minimum interval (seconds) between progress updates sent to the GUI (see progress)
+PROGRESS_INTERVAL = 0.25
+
+# Read-ahead buffer (bytes) for large input files (see open_with_progress)
+READ_AHEAD = 4 * 1024 * 1024
+
+# State of progress reporting for the running Execute; seq identifies each update sent
+_progress = {'execute': None, 'started': None, 'sent': 0, 'label': None, 'seq': 0}
+
+# Helpers available to all tool code; set up once per kernel (see setup_helpers)
+HELPER_NAMES = ['pathomx_notebook_start', 'pathomx_notebook_stop', 'progress', 'open_with_progress']
+
 
 class PathomxTool(object):
     ''' Simple wrapper class that holds the output data for a given tool; This is for user-friendliness
@@ -56,7 +77,14 @@ def pathomx_notebook_start(vars):
     if '_io' in vars:
         for k, v in vars['_io']['input'].items():
             if v in vars:
-                vars[k] = deepcopy(vars[v])
+                # Data passed through the shared store; map it in (once) for this kernel
+                vars[v] = transport.resolve(vars[v])
+                # Inputs are read-only views of the data held here, unless the tool is known
+                # to modify its inputs in place (see run_task)
+                if vars.get('_pathomx_copy_inputs'):
+                    vars[k] = deepcopy(vars[v])
+                else:
+                    vars[k] = transport.read_only(vars[v])
             else:
                 vars[k] = None
 
@@ -85,47 +113,505 @@ def pathomx_notebook_stop(vars):
             else:
                 vars[v] = None
 
+        # Return the declared outputs and views, plus any figures/display objects; nothing is
+        # rendered here (HTML views are rendered when shown, see displayobjects.Html). Tools
+        # that cannot declare their views (view_vars None; custom scripts) get any DataFrame or
+        # notebook aware object also, as views
+        view_vars = vars.get('_pathomx_expected_view_vars', [])
+        declared = set(vars.get('_pathomx_expected_output_vars', [])) | set(view_vars or [])
         for k, v in vars.items():
-            # Check it's an accepted type for passing; and not private (starts with _)
+            # Not private (starts with _) or an input
             if not k.startswith('_') and \
                 not k in vars['_io']['input'].keys():
 
-                if type(v) in MAGIC_TYPES or k in vars['_pathomx_expected_output_vars']:
+                if k in declared or type(v) in VIEW_TYPES:
                     varso[k] = v
 
-                elif hasattr(v, '_repr_html_'):
-                    try:
-                        # Check if it is a bound method (not a class definition)
-                        v._repr_html_()
-                    except:
-                        pass
-                    else:
-                        varso[k] = displayobjects.Html(v)
+                elif view_vars is None:
+                    if isinstance(v, pd.DataFrame):
+                        varso[k] = v
+
+                    elif hasattr(v, '_repr_html_') and not isinstance(v, type):
+                        # Arbitrary objects may not survive the trip to the GUI; send the HTML
+                        try:
+                            varso[k] = displayobjects.Html(displayobjects.Html.wrap(v))
+                        except Exception:
+                            pass
+
+        if '_pathomx_shared_store' in vars:
+            # Write large data to the shared store and return a proxy only; the GUI
+            # (and other kernels) will map it from there if and when it is needed
+            store = transport.SharedStore(vars['_pathomx_shared_store'])
+            for k, v in varso.items():
+                name = vars['_io']['output'].get(k, '_%s' % k)
+                try:
+                    if transport.is_shareable(v):
+                        varso[k] = transport.DataProxy(store.put(name, v), v)
+
+                    elif isinstance(v, Figure) and vars.get('_pathomx_render_figures'):
+                        # Return the rendered figure; the Figure is loaded on demand
+                        varso[k] = displayobjects.RenderedFigure(store.put(name, v), v)
+
+                except Exception as e:
+                    warnings.warn("Could not write %s to the shared store: %s" % (k, e))
 
     vars['varso'] = varso
 
-    
-def progress(progress):
-    ''' Output the current progress to stdout on the remote core
-        this will be read from stdout and displayed in the UI '''
-    print("____pathomx_execute_progress_%.2f____" % progress)
 
+def reset_namespace(shell):
+    ''' Clear the user namespace before running a tool, keeping private (_) variables
+        which hold the tool IO (and IPython's own hidden variables) '''
+    for k in list(shell.user_ns.keys()):
+        if not k.startswith('_') and k not in shell.user_ns_hidden:
+            del shell.user_ns[k]
+
+
+def setup_language(shell, language):
+    ''' Load the extension for the given language (will take time first time; but instant thereafter)
+        note: fails silently! '''
+    if language in LANGUAGE_EXTENSIONS:
+        try:
+            shell.extension_manager.load_extension(LANGUAGE_EXTENSIONS[language])
+        except Exception:
+            pass
+
+
+def setup_helpers(shell):
+    ''' Add the helpers to the user namespace; they are hidden, so are kept on reset_namespace '''
+    helpers = {k: globals()[k] for k in HELPER_NAMES}
+    shell.user_ns.update(helpers)
+    shell.user_ns_hidden.update(helpers)
+
+
+def setup(shell, s):
+    if s == 'helpers':
+        setup_helpers(shell)
+    else:
+        setup_language(shell, s)
+
+
+def warm_up(modules):
+    ''' Import the given modules, so they are ready for the first tools run on this kernel
+        returns the list of modules that could not be imported '''
+    failed = []
+    for m in modules:
+        try:
+            __import__(m)
+        except Exception:
+            failed.append(m)
+
+    return failed
+
+
+def evict(names):
+    ''' Remove the given (stale) variables from the user namespace, freeing the memory '''
+    import gc
+    from IPython import get_ipython
+    ns = get_ipython().user_ns
+    for n in names:
+        ns.pop(n, None)
+
+    gc.collect()
+
+
+# Hashes of tool code that modifies its inputs in place; these get copies of the input data
+_copy_inputs_code = set()
+
+
+def run_task(payloads, *varsis):
+    ''' Run each Execute of a Task in turn on this kernel, returning the results together
+
+        payloads is a list of dicts of setup (list of 'helpers' and/or languages not yet set up on
+        this kernel), code (list) and varso (list of names) for each Execute, with the matching varsi
+        passed as separate arguments (so data is sent as raw buffers). The start of each Execute is
+        marked in stdout so the output (and progress) can be matched to it. Returns a list of
+        result dicts, stopping at the first error, packed by pack_results.
+
+        Tools receive read-only views of their inputs (see pathomx_notebook_start). If the code
+        fails modifying one in place (before setting any of its outputs) it is run again with
+        copies, and gets copies from then on. '''
+    from IPython import get_ipython
+    shell = get_ipython()
+    ns = shell.user_ns
+
+    results = []
+    for n, (payload, varsi) in enumerate(zip(payloads, varsis)):
+        print("____pathomx_execute_start_%d____" % n)
+        sys.stdout.flush()
+        start_progress(n)
+
+        started = time.time()
+        setup_done = []
+        code_hash = hash(tuple(payload['code']))
+        try:
+            for s in payload['setup']:
+                setup(shell, s)
+                setup_done.append(s)
+
+            try:
+                run_code(shell, payload['code'], varsi, code_hash in _copy_inputs_code)
+
+            except ValueError as e:
+                if not transport.is_read_only_error(e) or code_hash in _copy_inputs_code:
+                    raise
+
+                # Only run again if the tool failed before producing output; it may have
+                # side effects (e.g. exports) that should not happen twice
+                if any([ns.get(v) is not None for v in varsi.get('_pathomx_expected_output_vars', [])]):
+                    raise
+
+                print("Input data modified in place; running again with a copy of the inputs")
+                _copy_inputs_code.add(code_hash)
+                run_code(shell, payload['code'], varsi, True)
+
+        except Exception:
+            etype, value, tb = sys.exc_info()
+            results.append({
+                'status': -1,
+                'traceback': '\n'.join(shell.InteractiveTB.structured_traceback(etype, value, tb)),
+                'setup': setup_done,
+            })
+            close_figures()
+            break
+
+        results.append({
+            'status': 0,
+            'varso': [ns.get(v) for v in payload['varso']],
+            'runtime': time.time() - started,
+            'setup': setup_done,
+        })
+        # Figures in the results are unaffected; they are only removed from pyplot
+        close_figures()
+
+    return pack_results(results)
+
+
+def pack_results(results):
+    ''' Move the output values of the results to the top level of the returned list, as
+        [results, value, value, ...]; IPython only sends top-level items as raw buffers (see
+        transport.register), anything nested is pickled whole. Each varso entry is replaced by the
+        index of its value, or for dicts a list of (key, index). Reversed by unpack_results '''
+    values = [None]
+    for r in results:
+        if r['status'] != 0:
+            continue
+
+        varso = []
+        for v in r['varso']:
+            if type(v) is dict:
+                varso.append([(k, len(values) + i) for i, k in enumerate(v.keys())])
+                values.extend(v.values())
+            else:
+                varso.append(len(values))
+                values.append(v)
+        r['varso'] = varso
+
+    values[0] = results
+    return values
+
+
+def unpack_results(values):
+    ''' Return the results packed by pack_results, with the output values back in place '''
+    results = values[0]
+    for r in results:
+        if r['status'] != 0:
+            continue
+
+        r['varso'] = [
+            dict((k, values[i]) for k, i in v) if isinstance(v, list) else values[v]
+            for v in r['varso']
+        ]
+
+    return results
+
+
+class _WorkerStdout(object):
+    ''' stdout of a worker process; written text is sent back to the GUI, tagged with the
+        current message, in blocks (at most every PROGRESS_INTERVAL, or on flush) '''
+
+    def __init__(self, send):
+        self.send = send
+        self.msg_id = None
+        self._buffer = []
+        self._sent = 0
+
+    def write(self, s):
+        if s and self.msg_id is not None:
+            self._buffer.append(s)
+            if time.time() - self._sent > PROGRESS_INTERVAL:
+                self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.send(('stdout', self.msg_id, ''.join(self._buffer)))
+            self._buffer = []
+        self._sent = time.time()
+
+
+class _WorkerDataPub(object):
+    ''' Data publisher of a worker process (see publish); data is sent back to the GUI, tagged
+        with the current message '''
+
+    def __init__(self, send, stdout):
+        self.send = send
+        self.stdout = stdout
+
+    def publish(self, data):
+        if self.stdout.msg_id is not None:
+            self.send(('data', self.stdout.msg_id, data))
+
+
+def worker_main(conn):
+    ''' Main loop of a worker process kernel (see backends.ProcessBackend)
+
+        Receives (msg_id, function, args) over the connection and runs each in turn, in an IPython
+        shell so tool code runs as on a cluster engine; variables persist between calls. Replies with
+        ('stdout', msg_id, text) and ('data', msg_id, dict) (see publish) while running, then
+        ('result', msg_id, value) or ('error', msg_id, traceback). Messages are read on a separate thread, so the GUI never blocks sending to a busy
+        worker. A None message (or closing the connection) stops the worker. '''
+    import signal
+    import threading
+    import traceback
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+
+    import matplotlib
+    matplotlib.use('Agg')
+
+    from IPython.core.interactiveshell import InteractiveShell
+    # A forked worker inherits the shell of the GUI process (if any); start afresh
+    InteractiveShell.clear_instance()
+    shell = InteractiveShell.instance()
+
+    lock = threading.Lock()
+
+    def send(msg):
+        with lock:
+            conn.send(msg)
+
+    stdout = _WorkerStdout(send)
+    sys.stdout = stdout
+    shell.data_pub = _WorkerDataPub(send, stdout)
+
+    # Interrupts stop the running function, as on an engine; when idle they are ignored
+    busy = [False]
+
+    def on_interrupt(signum, frame):
+        if busy[0]:
+            raise KeyboardInterrupt
+
+    signal.signal(signal.SIGINT, on_interrupt)
+
+    inbox = queue.Queue()
+
+    def receive():
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, IOError, OSError):
+                msg = None
+
+            inbox.put(msg)
+            if msg is None:
+                return
+
+    t = threading.Thread(target=receive)
+    t.daemon = True
+    t.start()
+
+    while True:
+        msg = inbox.get()
+        if msg is None:
+            break
+
+        msg_id, f, args = msg
+        stdout.msg_id = msg_id
+        try:
+            busy[0] = True
+            try:
+                reply = ('result', msg_id, f(*args))
+            finally:
+                busy[0] = False
+
+        except BaseException:
+            reply = ('error', msg_id, traceback.format_exc())
+
+        stdout.flush()
+        stdout.msg_id = None
+        try:
+            send(reply)
+        except Exception:
+            # The result could not be pickled
+            send(('error', msg_id, traceback.format_exc()))
+
+
+def run_code(shell, codes, varsi, copy_inputs=False):
+    ''' Run the code of a single Execute in the user namespace, with the given varsi '''
+    ns = shell.user_ns
+    if codes:
+        # Clear workspace before each run (a data push only adds private variables)
+        reset_namespace(shell)
+
+    ns.update(varsi)
+    ns['_pathomx_copy_inputs'] = copy_inputs
+    for code in codes:
+        # Apply the IPython input transforms, for magics (including other languages)
+        code = shell.input_transformer_manager.transform_cell(code)
+        exec(compile(code, cache_code(code), 'exec'), ns)
+
+
+def cache_code(code):
+    ''' Add the code to linecache under a name unique to it, so tracebacks show the source
+        (as for cells run through run_cell); returns the name '''
+    fn = '<pathomx-%s>' % hashlib.md5(code.encode('utf8')).hexdigest()[:12]
+    if fn not in linecache.cache:
+        # No mtime, so checkcache leaves the entry in place
+        linecache.cache[fn] = (len(code), None, code.splitlines(True), fn)
+    return fn
+
+
+def close_figures():
+    ''' Close all pyplot figures; tool code is not run through run_cell, so the inline backend
+        never flushes (and closes) them, and pyplot would hold on to every figure created '''
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
+
+
+def start_progress(execute):
+    ''' Reset the progress state at the start of each Execute (see run_task) '''
+    _progress.update({
+        'execute': execute,
+        'started': time.time(),
+        'sent': 0,
+        'label': None,
+    })
+
+
+def publish(data):
+    ''' Publish data to the GUI alongside the running task; on a cluster engine this is the
+        IPython data publication channel, on a worker process the pipe (see worker_main) '''
+    from IPython import get_ipython
+    shell = get_ipython()
+    data_pub = getattr(shell, 'data_pub', None) if shell else None
+    if data_pub is not None:
+        data_pub.publish(data)
+
+
+def progress(progress, label=None):
+    ''' Report the progress (0-1) of the current tool, with an optional label for the current step
+
+        Sent to the GUI separately from stdout, with the expected time remaining. Updates are sent at
+        most every PROGRESS_INTERVAL, so this can be called as often as is convenient; updates with a
+        new label, and completion, are always sent. '''
+    now = time.time()
+    if label is None:
+        label = _progress['label']
+
+    if now - _progress['sent'] < PROGRESS_INTERVAL and label == _progress['label'] and progress < 1:
+        return
+
+    elapsed = now - _progress['started'] if _progress['started'] else None
+    eta = elapsed * (1 - progress) / progress if elapsed and progress > 0 else None
+
+    _progress['sent'] = now
+    _progress['label'] = label
+    _progress['seq'] += 1
+    publish({
+        'seq': _progress['seq'],
+        'execute': _progress['execute'],
+        'progress': progress,
+        'label': label,
+        'eta': eta,
+    })
+
+
+class ProgressReader(io.RawIOBase):
+    ''' Raw binary reader over a file (or a memory map of it) that reports the fraction read
+        through progress as it goes; see open_with_progress '''
+
+    def __init__(self, fn, label=None, use_mmap=False):
+        super(ProgressReader, self).__init__()
+        self.name = fn
+        self.label = label
+
+        self._file = io.open(fn, 'rb', buffering=0)
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._mmap = None
+        self._pos = 0
+
+        # Empty files cannot be mapped
+        if use_mmap and self._size:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+
+        if self._mmap is None:
+            self._file.seek(offset)
+
+        self._pos = max(0, offset)
+        return self._pos
+
+    def readinto(self, b):
+        if self._mmap is not None:
+            data = self._mmap[self._pos:self._pos + len(b)]
+            n = len(data)
+            b[:n] = data
+        else:
+            n = self._file.readinto(b)
+
+        self._pos += n or 0
+        if self._size:
+            progress(min(1.0, float(self._pos) / self._size), self.label)
+
+        return n
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        if not self.closed:
+            if self._mmap is not None:
+                self._mmap.close()
+            self._file.close()
+
+        super(ProgressReader, self).close()
+
+
+def open_with_progress(fn, mode='r', buffering=READ_AHEAD, encoding=None, errors=None, newline=None, label=None, use_mmap=False):
+    ''' Open the file fn for reading, reporting the fraction read through progress
 
-class open_with_progress(io.IOBase):
+        Use in place of open (in read modes; 'U' is accepted and ignored, as newlines are
+        universal by default) for large input files, e.g. to pass to csv.reader, pd.read_csv or
+        et.parse. Reads ahead in blocks of buffering bytes; with use_mmap the file is memory
+        mapped rather than read. The progress label defaults to the file name.
 
-    def __init__(self, f, *args, **kwargs):
-        super(open_with_progress, self).__init__(f, *args, **kwargs)
+        On Python 2 text modes also return the binary reader (of str), as the csv module there
+        cannot handle unicode.
+    '''
+    mode = mode.replace('U', '')
+    if set(mode) - set('rbt') or 'r' not in mode:
+        raise ValueError("open_with_progress only supports read modes, not '%s'" % mode)
 
-        self._fsize = os.path.getsize(f)
-        self._progress = None
+    if label is None:
+        label = 'Reading %s' % os.path.basename(fn)
 
-    def read(self, *args, **kwargs):
-        super(open_with_progress, self).read(*args, **kwargs)
-        self.check_and_emit_progress()
+    f = io.BufferedReader(ProgressReader(fn, label=label, use_mmap=use_mmap), buffer_size=buffering)
+    if 'b' in mode or sys.version_info < (3, 0):
+        return f
 
-    def check_and_emit_progress(self):
-        # We only output at 2dp so only emit when that changes
-        prg = round(self.tell() / self._fsize, 2)
-        if prg != self._progress:
-            self._progress = prg
-            progress(prg)
+    return io.TextIOWrapper(f, encoding=encoding, errors=errors, newline=newline)
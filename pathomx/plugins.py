@@ -21,7 +21,8 @@ import shutil
 from . import utils
 from . import ui
 from .globals import settings, app_launchers, file_handlers, url_handlers, available_tools_by_category, \
-                     plugin_categories, plugin_manager, plugin_objects, plugin_metadata, installed_plugin_names
+                     plugin_categories, plugin_manager, plugin_objects, plugin_metadata, installed_plugin_names, \
+                     notebook_queue
 
 import pip
 
@@ -114,6 +115,31 @@ def get_available_plugins(plugin_places=None, include_deactivated=False):
     # for pkg_ver in required_packages_all:
     #    pip.main(['install', pkg_ver, '--upgrade'])
 
+    notebook_queue.set_warm_up_modules(get_warm_up_modules())
+
+
+def get_warm_up_modules():
+    '''
+    Return the modules to import on each kernel as it starts: those configured, plus all
+    modules imported by the tool scripts of the installed plugins
+    '''
+    if not utils.setting_bool(settings.get('Runner/Warm_up')):
+        return []
+
+    modules = list(settings.get('Runner/Warm_up_modules'))
+    for metadata in plugin_metadata.values():
+        for fn in sorted(os.listdir(metadata['path'])):
+            if not fn.endswith('.py') or fn in ['loader.py', '__init__.py']:
+                continue
+
+            try:
+                modules.extend(utils.find_imports(os.path.join(metadata['path'], fn)))
+            except (IOError, OSError, ValueError):
+                pass
+
+    # Unique, in order
+    return [m for n, m in enumerate(modules) if m not in modules[:n]]
+
 
 class pluginListDelegate(QAbstractItemDelegate):
 
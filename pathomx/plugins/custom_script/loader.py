@@ -9,6 +9,9 @@ from pathomx.qt import *
 
 
 class CustomScriptTool(GenericTool):
+
+    view_vars = None  # Any data or display objects created by the script
+
     def __init__(self, *args, **kwargs):
         super(CustomScriptTool, self).__init__(*args, **kwargs)
 
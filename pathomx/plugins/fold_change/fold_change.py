@@ -13,6 +13,7 @@ classes = [v[class_idx] for v in input_data.index.values]
 if config['use_baseline_minima']:
     # Add option for column or global minima here
     data_minima = input_data[input_data > 0].min().min() / 2
+    input_data = input_data.copy()
     input_data[input_data <= 0] = data_minima
 
 control_data = input_data.xs(_experiment_control, level=class_idx)
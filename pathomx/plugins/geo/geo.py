@@ -75,7 +75,7 @@ def get_soft_data(rows, starts, ends):
 # SOFT files are a /sort of/ bastardized csv with data in tab-separated columns
 # So, we use the csv reader to get that, accounting for most stuff being single field with
 # slightly strange identifiers
-with open(config['filename'], 'rU') as f:
+with open_with_progress(config['filename'], 'rU') as f:
     reader = csv.reader(f, delimiter='\t', dialect='excel')
 
     soft_data = preprocess_soft(reader, f=f)
@@ -20,7 +20,8 @@ def decode(s):
 # Determine if we've got a csv or peakml file (extension)
 
 # Read data in from peakml format file
-xml = et.parse(config['filename'])
+with open_with_progress(config['filename'], 'rb', use_mmap=True) as f:
+    xml = et.parse(f)
 
 # Get sample ids, names and class groupings
 sets = xml.iterfind('header/sets/set')
@@ -35,7 +35,7 @@ else:
     row_headers = list(range(config['row_headers']) )
 
 
-with open(config['filename'], 'rU') as f:
+with open_with_progress(config['filename'], 'rU') as f:
 
     if config['transpose']:
 
@@ -1,7 +1,8 @@
 import pandas as pd
 
 
-df = pd.read_csv(config['filename'], delimiter='\t')
+with open_with_progress(config['filename'], 'rU') as f:
+    df = pd.read_csv(f, delimiter='\t')
 
 _FILTER_PROBABILITIES = df['Localization prob'] >= 0.75
 df = df[_FILTER_PROBABILITIES]
@@ -12,7 +12,7 @@ data_col = 18
 #sample    1    2    3    4
 #class    ADG10003u_007    ADG10003u_008    ADG10003u_009    ADG10003u_010   ADG19007u_192
 #2-oxoisovalerate    0.3841    0.44603    0.45971    0.40812
-with open(config['filename'], 'rU') as f:
+with open_with_progress(config['filename'], 'rU') as f:
     reader = csv.reader(f, delimiter='\t', dialect='excel')
 
     # Sample identities from top row ( sample labels )
@@ -51,6 +51,8 @@ class PLSDATool(ui.AnalysisApp):
     legacy_launchers = ['PLSDAPlugin.PLSDAApp']
     legacy_inputs = {'input': 'input_data'}
 
+    view_vars = ['scores', 'weights']
+
     def __init__(self, *args, **kwargs):
         super(PLSDATool, self).__init__(*args, **kwargs)
         # Define automatic mapping (settings will determine the route; allow manual tweaks later)
@@ -249,7 +249,7 @@ for n, fid in enumerate(fids):
         nmr_dic.append(dic)
         _ppm_real_scan_folder = fid
 
-    progress(float(n) / total_fids)  # Emit progress update
+    progress(float(n) / total_fids, 'Reading spectra')  # Emit progress update
 
 if _ppm_real_scan_folder:
     # Nothing worked
@@ -15,7 +15,7 @@ zf.extract('peptides.txt', folder)
 datafile = os.path.join(folder, 'peptides.txt')
 
 # Read in data for the graphing metabolite, with associated value (generate mean)
-with open(datafile, 'r') as f:
+with open_with_progress(datafile, 'r', label='Reading peptides.txt') as f:
     reader = csv.reader(f, delimiter='\t', dialect='excel')
 
     # Get top row
@@ -27,6 +27,8 @@ cbf_last_pc = config.get('cbf_last_pc')
 cbf_explicit_start = config.get('cbf_explicit_start')
 cbf_explicit_end = config.get('cbf_explicit_start')
 
+output_data = input_data.copy()
+
 for n, dr in enumerate(input_data.values):
 
     if algorithm == 'median':
@@ -38,9 +40,7 @@ for n, dr in enumerate(input_data.values):
     elif algorithm == 'cbf_explicit':
         dr = ng.process.proc_bl.cbf_explicit(dr, calc=slice(cbf_explicit_start, cbf_explicit_end))
 
-    input_data.values[n, :] = dr
-
-output_data = input_data
+    output_data.values[n, :] = dr
 
 # Generate simple result figure (using pathomx libs)
 from pathomx.figures import spectra
@@ -2,9 +2,8 @@ import numpy as np
 
 minima = input_data[input_data > 0].min().min() / 2  # 
 # Get the dso filtered by class
-input_data[input_data <= 0] = minima
-
-output_data = input_data
+output_data = input_data.copy()
+output_data[output_data <= 0] = minima
 
 # Generate simple result figure (using pathomx libs)
 from pathomx.figures import spectra
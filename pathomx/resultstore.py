@@ -0,0 +1,151 @@
+from __future__ import unicode_literals
+import os
+import shutil
+import json
+import logging
+
+from . import transport
+from . import displayobjects
+from .runqueue import ToolJob
+
+# Tool results saved alongside a workflow (.mpf), so a reopened workflow has its results in place
+# without re-running everything. The store is a directory next to the workflow file containing:
+#
+#   index.json                  - tool id (as in the workflow) -> result key and result files
+#   <tool id>_<name>.pickle     - each value of the tool result (varso) with large arrays replaced by:
+#   <tool id>_<name>_<n>.npy    - raw arrays, which are memory-mapped on load (so only read when used)
+#
+# On load the result key of each tool is recalculated from the reopened workflow (code, config,
+# plugin version, global vars and inputs; see ToolJob.result_key) and stored results are only used where
+# the keys match.
+
+STORE_VERSION = 1
+
+
+def store_path(fn):
+    return os.path.splitext(fn)[0] + '.results'
+
+
+def _saved_value(v):
+    # Rendered figures refer to the Figure in the shared store of this session; save the Figure
+    if isinstance(v, displayobjects.RenderedFigure):
+        return v.embedded()
+    return transport.resolve(v)
+
+
+def _dump_result(varso, path, prefix):
+    """
+    Save each value of varso to <prefix>_<name>.pickle (plus .npy files). Returns a dict of
+    name: pickle file; values that cannot be pickled (e.g. some figures) are skipped.
+    """
+    files = {}
+    for k, v in varso.items():
+        try:
+            files[k] = transport.dump(_saved_value(v), path, '%s_%s' % (prefix, k))
+        except Exception as e:
+            logging.debug("Could not save result '%s': %s" % (k, e))
+
+    return files
+
+
+def _load_result(path, files):
+    return {k: transport.load(path, fn) for k, fn in files.items()}
+
+
+def save(fn, tools):
+    """
+    Save the current results of the tools alongside the workflow file fn
+
+    The store is written to a temporary directory and swapped in on completion, as the
+    existing store may be in use (memory-mapped) by the current workflow.
+    """
+    path = store_path(fn)
+    tmp_path = '%s.tmp-%d' % (path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    index = {'version': STORE_VERSION, 'tools': {}}
+    for t in tools:
+        varso = t._latest_generator_result
+        if varso is None or t.result_key is None:
+            continue
+
+        files = _dump_result(varso, tmp_path, t.id)
+        if not set(t.data.o.keys()) <= set(files.keys()):
+            # Without the outputs the result is no use to downstream tools
+            logging.warning("Could not save results for %s" % t.name)
+            continue
+
+        index['tools'][t.id] = {
+            'key': t.result_key,
+            'files': files,
+        }
+
+    with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+    if os.path.exists(path):
+        try:
+            shutil.rmtree(path)
+        except OSError:
+            # Files in use (Windows); leave the existing store and the temporary one
+            logging.warning("Could not replace saved results at %s" % path)
+            return False
+
+    os.rename(tmp_path, path)
+    logging.info("Saved results for %d tools to %s" % (len(index['tools']), path))
+    return True
+
+
+def load(fn, tools_by_id):
+    """
+    Load the saved results for the workflow file fn
+
+    tools_by_id maps the tool ids in the saved workflow to the (newly created) tools.
+    Returns a dict of tool: (result key, varso) for the stored results that are still
+    valid for the tool as currently configured.
+    """
+    path = store_path(fn)
+    try:
+        with open(os.path.join(path, 'index.json'), 'r') as f:
+            index = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+    if index.get('version') != STORE_VERSION:
+        return {}
+
+    stored = index['tools']
+
+    # Result keys chain from the parents' keys, so calculate in order, parents first
+    result_keys = {}
+    results = {}
+
+    def check(t):
+        if t in result_keys:
+            return
+
+        for p in t.get_parents():
+            check(p)
+
+        key = ToolJob.result_key(t, t.config.as_dict(), result_keys, global_key)
+        result_keys[t] = key
+
+        entry = stored.get(tool_ids[t])
+        if entry is None or entry['key'] != key:
+            return
+
+        try:
+            results[t] = (key, _load_result(path, entry['files']))
+        except Exception as e:
+            logging.warning("Could not load saved results for %s: %s" % (t.name, e))
+
+    tool_ids = {t: i for i, t in tools_by_id.items()}
+    # The global vars (rcParams, styles) are the same for all tools
+    global_key = ToolJob.global_key(list(tools_by_id.values())[0].get_global_varsi()) if tools_by_id else ''
+    for t in tools_by_id.values():
+        check(t)
+
+    logging.info("Loaded saved results for %d of %d tools" % (len(results), len(tools_by_id)))
+    return results
@@ -1,6 +1,6 @@
 import logging
 
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, OrderedDict
 
 from .qt import *
 
@@ -8,19 +8,34 @@ from IPython.qt.base_frontend_mixin import BaseFrontendMixin
 from IPython.qt.inprocess import QtInProcessKernelManager as KernelManager
 from IPython.qt.console.ansi_code_processor import QtAnsiCodeProcessor
 
-from IPython.parallel import Client, TimeoutError, RemoteError
 from IPython.utils.pickleutil import use_dill
 use_dill()
 
+from . import transport
+transport.register()
+
 from datetime import datetime
 import re
 import os
 import sys
-from subprocess import Popen
-from IPython.parallel.apps import ipclusterapp
+import time
+import heapq
+import hashlib
+import multiprocessing
+import weakref
+import signal
+
+try:
+    import xml.etree.cElementTree as et
+except ImportError:
+    import xml.etree.ElementTree as et
 
 from matplotlib import rcParams
 
+from . import utils
+from .kernel_helpers import run_task, unpack_results, warm_up, evict, LANGUAGE_EXTENSIONS
+from .backends import BACKENDS, TaskError
+
 # Kernel is busy but not because of us
 STATUS_BLOCKED = -1
 
@@ -32,12 +47,37 @@ STATUS_COMPLETE = 2
 # Error status
 STATUS_ERROR = 3
 
+# Job priorities; higher runs first
+PRIORITY_BATCH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_INTERACTIVE = 2
+
+# Jobs gain one priority level for each this many seconds waiting for a runner (so none starve)
+JOB_AGING_INTERVAL = 30
+
+
+EXECUTE_START_REGEXP = re.compile("____pathomx_execute_start_(\d+)____\n?")
+
+# Wait for a busy runner that already holds the input data (rather than pushing it to an
+# idle runner) when more than this many bytes would need to be moved
+LOCALITY_WAIT_BYTES = 64 * 1024 * 1024
 
-AR_PUSH = 1
-AR_EXECUTE = 2
-AR_PULL = 3
+# Approximate rate at which data can be pushed between kernels (bytes/second)
+TRANSFER_BYTES_PER_SECOND = 100 * 1024 * 1024
 
-PROGRESS_REGEXP = re.compile("____pathomx_execute_progress_(.*)____")
+# Assumed runtime (seconds) for tools that have not yet been run
+DEFAULT_TOOL_RUNTIME = 1.0
+
+# Default size limit of the tool result cache (bytes)
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+
+# Memory allowed for each engine when determining the default number of engines, and
+# assumed for a new engine until the memory use of running engines is known (bytes)
+ENGINE_MEMORY = 1024 * 1024 * 1024
+
+# Engines idle for longer than this (seconds) are stopped, down to IDLE_ENGINES
+ENGINE_IDLE_TIMEOUT = 300
+IDLE_ENGINES = 2
 
 # Job submitted as initiating tool
 # Pre-calculate the execution order and flow (save the round-trip execution) stopping at paused tools
@@ -58,6 +98,23 @@ PROGRESS_REGEXP = re.compile("____pathomx_execute_progress_(.*)____")
 
 
 
+def default_engine_count():
+    """
+    Return the default (maximum) number of engines: one per CPU core, leaving one for the GUI,
+    limited so that each engine has ENGINE_MEMORY available
+    """
+    try:
+        n = max(1, multiprocessing.cpu_count() - 1)
+    except NotImplementedError:
+        n = 4
+
+    memory = utils.total_memory()
+    if memory:
+        n = min(n, max(1, int(memory // ENGINE_MEMORY)))
+
+    return n
+
+
 # from pkg_resources import load_entry_point
 # load_entry_point('ipython==3.0.0-dev', 'console_scripts', 'ipcluster')()
 # IPython.parallel.apps.ipclusterapp:launch_new_instance'
@@ -66,16 +123,88 @@ PROGRESS_REGEXP = re.compile("____pathomx_execute_progress_(.*)____")
 
 
 
+class ResultCache(object):
+    """
+    Least-recently-used cache of tool results (varso), keyed by a hash of everything that
+    determines the result: the tool code, config, plugin version, global vars (rcParams, styles)
+    and the keys (or content) of the input data. See ToolJob.result_key.
+
+    The total size of cached results is limited to max_size bytes; the least recently
+    used results are discarded first. Results larger than the limit are not cached.
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._results = OrderedDict()  # key: (varso, size, tag)
+
+    def __contains__(self, key):
+        return key in self._results
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, key):
+        """
+        Return the cached varso for the given key, or None
+        """
+        if key not in self._results:
+            return None
+
+        # Move to the end (most recently used)
+        entry = self._results.pop(key)
+        self._results[key] = entry
+        return entry[0]
+
+    def put(self, key, varso, tag=None):
+        """
+        Store varso under the given key; the optional tag (e.g. the tool id) can be used
+        to invalidate a group of results together
+        """
+        if key is None:
+            return False
+
+        self.invalidate(key)
+
+        size = sum([utils.data_size(v) for v in varso.values()])
+        if size > self.max_size:
+            return False
+
+        self._results[key] = (varso, size, tag)
+        self.size += size
+        self.trim()
+        return True
+
+    def trim(self):
+        # Discard least recently used results until we are within the limit
+        while self.size > self.max_size and self._results:
+            key, (varso, size, tag) = self._results.popitem(last=False)
+            self.size -= size
+
+    def invalidate(self, key):
+        if key in self._results:
+            varso, size, tag = self._results.pop(key)
+            self.size -= size
+
+    def invalidate_tag(self, tag):
+        for key in [k for k, (v, s, t) in self._results.items() if t == tag]:
+            self.invalidate(key)
+
+    def clear(self):
+        self._results = OrderedDict()
+        self.size = 0
+
+
 class Runner(QObject):
     """
-    A runner object that handles running an Task object on an IPython cluster kernel
+    A runner object that handles running an Task object on a kernel of the execution backend (see backends)
 
     Each Task object consists of multiple Exec objects which can be executed immediately in turn.
     (scheduling is already handled by the Job object the Task is provided by).
 
     Each Exec can include varsi (vars in), code, varso (vars out) and pre-execution non-Python code setup.
-    The code is passed as a list of multiple objects, which must be executed then watched for output
-    via the AsyncResult object.
+    The code is passed as a list of multiple objects. The whole Task is sent to the kernel in a single
+    call, then watched for output via the AsyncResult object.
 
     Callbacks are fired on the originating Exec object for progress, success, failure of any step.
     """
@@ -89,180 +218,355 @@ class Runner(QObject):
         self.reset()
         self._status = STATUS_READY
 
-        # Check over ASync objects for updated status
-        self.status_timer = QTimer()
-        self.status_timer.timeout.connect(self.check_status)
-        self.status_timer.start(100)  # 0.1 sec
+        # Helpers and languages already set up on the kernel (see kernel_helpers.setup); these
+        # persist between Tasks so are only set up on first use
+        self.initialised = set()
+
+        # ASyncResult of the module imports run when the kernel starts (see warm_up)
+        self.warm_up_ar = None
+
+        # Resident memory use of the engine (see update_memory)
+        self.rss = None
 
-        # Trigger to update the progress of running Exec objects (scan stdout of ARs for progress)
-        self.progress_timer = QTimer()
-        self.progress_timer.timeout.connect(self.check_progress)
-        self.progress_timer.start(500)  # 1 sec
+        # Tool data held on the kernel (see Execute metadata 'resident'), as variable name: weakref to the tool
+        self.resident = {}
+
+        # Number of messages queued on the engine by anyone (including us); this is
+        # refreshed by the Queue rather than querying the hub on every status check
+        self.queue_length = 0
+
+        # Status and progress are checked by the Queue when the backend receives
+        # messages (see Backend.activity), so there are no timers here
 
     @property
     def is_active(self):
-        return self._is_active or self.k.queue_status()['queue'] > 0
+        return self._is_active or self.queue_length > 0
+
+    def remaining_runtime(self):
+        """
+        Return the expected time (seconds) until the current Task completes, based on previous runs
+        """
+        if self.task is None or self.started is None:
+            return 0
+        return max(0, self.task.runtime - (time.time() - self.started))
+
+    def is_overdue(self):
+        """
+        Return True if the current Task has run longer than expected; there is then no
+        estimate of when it will complete
+        """
+        return self.task is not None and self.started is not None and \
+            time.time() - self.started > self.task.runtime
+
+    @property
+    def pid(self):
+        return self.k.pid
+
+    def update_memory(self):
+        """
+        Update the resident memory use (bytes) of the engine; all engines are local
+        """
+        self.rss = utils.process_rss(self.pid) if self.pid else None
+        return self.rss
+
+    def stale_vars(self):
+        """
+        Return the names of the variables on the kernel holding data which is no longer current:
+        the tool has since been run elsewhere (or deleted), so the data will not be used again
+        """
+        stale = []
+        for name, ref in self.resident.items():
+            t = ref()
+            if t is None or id(self.k) not in t.current_data_on_kernels:
+                stale.append(name)
+
+        return stale
+
+    def evict_stale(self):
+        """
+        Remove stale tool data from the kernel; the removal is queued on the kernel (we don't wait)
+        """
+        stale = self.stale_vars()
+        if stale:
+            logging.debug("Evicting %d stale variables from kernel %s" % (len(stale), id(self.k)))
+            self.k.apply_async(evict, stale)
+            for name in stale:
+                del self.resident[name]
+
+    def release_data(self):
+        """
+        Mark the tool data held on the kernel as unavailable, when the engine is stopped
+        """
+        for ref in self.resident.values():
+            t = ref()
+            if t is not None:
+                t.current_data_on_kernels.discard(id(self.k))
+
+        self.resident = {}
+
+    @property
+    def is_warm(self):
+        """
+        True once the warm-up imports have completed on the kernel
+        """
+        return self.warm_up_ar is None or self.k.is_done(self.warm_up_ar)
+
+    def warm_up(self, modules):
+        """
+        Import the given modules on the kernel in the background, so the first tools run here do not
+        pay the import cost. Tasks sent meanwhile are queued on the kernel behind the imports.
+        """
+        self.warm_up_ar = self.k.apply_async(warm_up, modules)
 
     @property
     def status(self):
-        if self._status == STATUS_READY and self.k.queue_status()['queue'] > 0:
+        if self._status == STATUS_READY and self.queue_length > 0:
             return STATUS_BLOCKED
         else:
             return self._status
 
-    def setup_language(self, language):
-        if language == 'r':
-            # Init R library loader (will take time first time; but instant thereafter)
-            self.k.execute(r'''%load_ext rpy2.ipython''')
-
-        elif language == 'matlab':
-            # Init MATLAB
-            self.k.execute(r'''%load_ext pymatbridge''')
-
     def run(self, task):
         """
         Takes a single Task object and executes all Exec objects from within immediately on the available kernel.
+
+        The whole Task is sent to the kernel in a single apply call (see kernel_helpers.run_task), which
+        runs each Execute in turn and returns all the results together.
         """
 
         if self.is_active:
             logging.error("Runner kernel not ready, but it got a job. Job ignored.")
             return False
 
-        # Dicts for accessing the running Exec from the AR and vice versa
+        # Clear the pending ASyncResult
         self.reset()
 
         self._is_active = True
         self._status = STATUS_RUNNING
 
         self.task = task
+        self.started = time.time()
 
-
+        payloads = []
+        varsis = []
+        pending_setup = set(self.initialised)
         for e in task.execute:
+            setup = []
+            if e.code:
+                for s in ['helpers', e.language]:
+                    if s not in pending_setup and (s == 'helpers' or s in LANGUAGE_EXTENSIONS):
+                        setup.append(s)
+                        pending_setup.add(s)
+
+            payloads.append({
+                'setup': setup,
+                'code': e.code or [],
+                'varso': e.varso or [],
+            })
+            # Passed as separate arguments, so the data in each is sent as raw buffers
+            varsis.append(e.varsi or {})
+
+        self.ar = self.k.apply_async(run_task, payloads, *varsis)
+        return True
 
-            # Clear workspace before each task run
-            self.k.execute('%reset_selective -f [^_]')
+    @staticmethod
+    def split_stdout(stdout):
+        """
+        Return a dict of Execute index: stdout, split at the markers written by run_task
+        """
+        parts = EXECUTE_START_REGEXP.split(stdout or '')
+        return {int(n): s for n, s in zip(parts[1::2], parts[2::2])}
 
-            # Execute language-specific setup if required; note: fails silently!
-            self.setup_language(e.language)
-            ars = []
+    def check_status(self):
+        """
+        Check for completion of the executing Task.
 
-            if e.varsi:
-                ar = self.k.push( e.varsi, block=False)
-                ars.append(ar)
-                self.ar_types[ar] = AR_PUSH
+        This is called by the Queue whenever the backend receives messages, so
+        there is no polling. The results of all Execute objects arrive together, in order,
+        and are passed on via the Execute-linked callbacks. The stdout of the Task is split
+        between the Execute objects at the markers written on the kernel. Execution stops
+        at the first error; the error is passed to the failing Execute and the Task errored.
 
-            if e.code:
-                for c in e.code:
-                    ar = self.k.execute(c, block=False)
-                    ars.append(ar)
-                    self.ar_types[ar] = AR_EXECUTE
+        """
+        if not self._is_active:
+            return False
 
-            if e.varso:
-                for v in e.varso:
-                    ar = self.k.pull(v, block=False)
-                    ars.append(ar)
-                    self.ar_types[ar] = AR_PULL
+        if self.task is not None and self.task.job.is_cancelled:
+            self.cancel()
+            return True
 
-            self.ar_by_exec[e] = ars
+        if not self.k.is_done(self.ar):
+            # Still waiting on the result
+            return False
 
+        try:
+            results = unpack_results(self.k.get(self.ar))
+
+        except TaskError as e:
+            # Failed outside of the tool code (e.g. sending the data or a lost worker)
+            results = [{
+                'status': -1,
+                'traceback': e.traceback,
+            }]
+
+        stdout = self.split_stdout(self.k.stdout(self.ar))
+        task = self.task
+
+        for n, (ex, r) in enumerate(zip(task.execute, results)):
+            self.initialised.update(r.get('setup', []))
+
+            if ex.is_cancelled:
+                # Already cancelled; the data on the kernel is no longer the tool's current data
+                t = ex.metadata.get('tool') if ex.metadata else None
+                if t is not None:
+                    t.current_data_on_kernels.discard(id(self.k))
+                continue
 
-    def check_status(self):
-        """
-        Automatically check for progress on the executing Execute objects.
+            if r['status'] == 0 and ex.metadata:
+                for name, t in ex.metadata.get('resident', {}).items():
+                    self.resident[name] = weakref.ref(t)
+
+            if r['status'] != 0:
+                # Handle all code exceptions and pass back the exception
+                result = {
+                    'status': -1,
+                    'traceback': r['traceback'],
+                    'stdout': stdout.get(n, ''),
+                }
+
+                # Stop here
+                self.reset()
+                self._status = STATUS_ERROR
+
+                # Emit the task-error signal (cancel dependencies)
+                task.error.emit()
 
-        We can iterate the dict of ASyncResult objects by original Execute. Using the
-        type of the ASyncResult we can then perform the appropriate action on the data,
-        using the Execute-linked callbacks to pass the data on. This makes handling
-        different Execute types relatively seamless.
+                # Emit the error via the Execute object (to the tool)
+                ex.result.emit(result)
 
+                # The remaining Executes will not report; fail them too so no tool is left active
+                for ex in task.execute[n + 1:]:
+                    if not ex.is_cancelled:
+                        ex.result.emit(result)
+                return True
+
+            if not ex.varso:
+                ex.complete.emit()
+                continue
+
+            varso = r['varso'][0] if len(r['varso']) == 1 else r['varso']
+
+            # Large data (and figures) are returned as proxies to the shared store; we now own that data
+            if isinstance(varso, dict):
+                for v in varso.values():
+                    if isinstance(v, transport.SharedProxy):
+                        v.own()
+
+            result = {
+                'status': 0,
+                'varso': varso,
+                'stdout': stdout.get(n, ''),
+                'kernel': id(self.k),
+                # Time spent executing on the engine; used to weight future job planning
+                'runtime': r['runtime'],
+            }
+            ex.complete.emit()
+            ex.result.emit(result)
+
+        logging.debug("Ran task %s on kernel %s in %.3fs (%.3fs in tools)" % (
+            id(task), id(self.k), self.k.wall_time(self.ar), sum([r.get('runtime', 0) for r in results])))
+
+        # All Execute objects have completed; release the kernel then notify
+        self._status = STATUS_READY
+        self.reset()
+
+        if task:
+            # Emit the task-complete signal (allow dependencies to run)
+            task.complete.emit()
+
+        return True
+
+    def cancel(self):
         """
-        if not self.is_active:
-            return False
+        Stop the current Task on the kernel and release the runner immediately
 
-        ars_waiting = False
+        If the Task has not yet started on the engine it is aborted, otherwise the engine is
+        interrupted; only once the Task has started, so nothing else is interrupted. Any
+        results are discarded. The Task may have replaced tool data on the kernel before it
+        was stopped, so the kernel no longer counts as holding the current data of any tool
+        in the Task. Returns the cancelled Task.
+        """
+        if not self._is_active or self.ar is None:
+            return None
 
-        for ex, ars in self.ar_by_exec.items():
-            # e is the original Exec object (for callbacks)
-            # ars is a list of ASyncResult objects originating from it
+        task = self.task
+        if self.k.abort(self.ar) and self.is_started():
+            # The Task is running (not queued behind something else, or already finished), so
+            # the interrupt stops it and nothing else
+            self.interrupt()
 
-                # Finally iterate each object
-                for ar in ars:
-                    ar_type = self.ar_types[ar]
-                    try:
-                        ar_result = ar.get(0)
+        for e in task.execute:
+            t = e.metadata.get('tool') if e.metadata else None
+            if t is not None:
+                t.current_data_on_kernels.discard(id(self.k))
 
-                    except TimeoutError:
-                        ars_waiting = True
+        logging.debug("Cancelled task %s on kernel %s" % (id(task), id(self.k)))
+        self._status = STATUS_READY
+        self.reset()
+        return task
 
-                    except RemoteError as e:
-                        # Handle all code exceptions and pass back the exception
-                        result = {
-                            'status': -1,
-                            'traceback': '\n'.join(e.render_traceback()),
-                            'stdout': self.stdout + ar.stdout,
-                        }
+    def is_started(self):
+        """
+        True once the current Task has started on the engine; run_task marks the start of each
+        Execute in stdout, before anything else
+        """
+        return self.ar is not None and bool(self.k.stdout(self.ar))
 
-                        # Emit the task-error signal (cancel dependencies)
-                        self.task.error.emit()
+    def interrupt(self):
+        """
+        Interrupt the code running on the engine (raising KeyboardInterrupt); not available on Windows
+        """
+        if self.pid is None or os.name == 'nt':
+            return False
 
-                        # Emit the error via the Execute object (to the tool)
-                        ex.result.emit(result)
+        try:
+            os.kill(self.pid, signal.SIGINT)
+        except OSError as e:
+            logging.warning("Could not interrupt kernel: %s" % e)
+            return False
 
-                        self._status = STATUS_ERROR
-                        # Interrupt and stop here
-                        self.reset()
-
-                    else:
-                        # Success on retrieve
-                        if ar_type == AR_PUSH:
-                            ex.complete.emit()
-
-                        if ar_type == AR_EXECUTE:
-                            # We should emit the complete notification here; but we have no way of
-                            # knowing whether the AR relates the first, or 50th exec that was triggered?
-                            self.stdout += ar.stdout
-                            ex.complete.emit()
-
-                        if ar_type == AR_PULL:
-                            result = {
-                                'status': 0,
-                                'varso': ar_result,
-                                'stdout': self.stdout + ar.stdout,
-                                'kernel': id(self.k)
-                            }
-                            ex.complete.emit()
-                            ex.result.emit(result)
-
-        # Check if all jobs have completed; then shutdown and exit
-        if not ars_waiting:
-            if self.task:
-                # Emit the task-complete signal (allow dependencies to run)
-                self.task.complete.emit()
-
-            # Reset this kernel, ready to go
-            self._status = STATUS_READY
-            self.reset()
+        return True
 
     def reset(self):
         self._is_active = False  # Release this kernel
-        self.ar_by_exec = {}
-        self.ar_types = {}
-        self.stdout = ""
+        self.ar = None
+        self.started = None
         self.task = None
+        self.idle_since = time.time()
+        self._progress_seq = None
 
     def check_progress(self):
-        if self.status != STATUS_RUNNING:
+        """
+        Pass on the latest progress published by the running Execute (see kernel_helpers.progress)
+
+        Only the latest update is held, so this is cheap however much is output by the tool;
+        updates are passed on once (identified by their sequence number).
+        """
+        if self.status != STATUS_RUNNING or self.ar is None:
             return False
 
+        data = self.k.data(self.ar)
+        if not data or data.get('seq') == self._progress_seq:
+            return False
 
+        self._progress_seq = data['seq']
+        n = data.get('execute')
+        if n is None or n >= len(self.task.execute):
+            return False
 
-        for ex, ars in self.ar_by_exec.items():
-            for ar in ars:
-                lines = ar.stdout.split('\n')
-                for l in lines:
-                    m = PROGRESS_REGEXP.match(l)
-                    if m:
-                        ex.progress.emit(float(m.group(1)))
+        e = self.task.execute[n]
+        e.progress.emit(data['progress'])
+        e.progress_info.emit({k: data.get(k) for k in ['progress', 'label', 'eta']})
+        return True
 
 
 
@@ -276,7 +580,9 @@ class Execute(QObject):
 
     result = pyqtSignal(dict)
     progress = pyqtSignal(float)
+    progress_info = pyqtSignal(dict)  # progress, label (of the current step) and eta (seconds)
     complete = pyqtSignal()
+    cancelled = pyqtSignal()
 
     def __init__(self, varsi=None, code=None, varso=None, language="python", metadata=None):
         super(Execute, self).__init__()
@@ -288,6 +594,8 @@ class Execute(QObject):
         self.varso = varso
 
         self.metadata = metadata
+        # Set when cancelled while its Task runs; the result is then discarded (see Runner.check_status)
+        self.is_cancelled = False
 
 
 class Task(QObject):
@@ -335,6 +643,11 @@ class Task(QObject):
         # Execution
         self.execute = execute
 
+        # Longest remaining chain of runtime from the head of this task (set by the planner)
+        self.priority = 0
+        # Expected runtime of this task (seconds)
+        self.runtime = 0
+
         # Kernel that this Exec is/was running on
         self.kernel = None
 
@@ -343,7 +656,10 @@ class Task(QObject):
         self.error.connect(self.errored)
 
     def ready(self):
-        pass
+        """
+        Return True if all the Tasks this one depends on have completed
+        """
+        return len( set(self.dependencies) - set(self.job.tasks_complete) ) == 0
 
     def completed(self):
         # Remove this exec object from the running list
@@ -375,16 +691,32 @@ class Job(QObject):
 
     """
 
-    def __init__(self):
+    def __init__(self, priority=PRIORITY_NORMAL):
         super(Job, self).__init__()
 
+        self.priority = priority
+        # Order of submission and time since last given a runner; set by the Queue
+        self.seq = None
+        self.waiting_since = None
+
         self.status = STATUS_READY
         self.tasks_queued = []
         self.tasks_running = []
         self.tasks_complete = []
         self.tasks_errored = []
+        self.tasks_cancelled = []
+
+        # Tools covered by this job (used to identify superseded jobs)
+        self.tool_list = []
+
+        # ResultCache and SharedStore to use for this job; assigned by the Queue
+        self.cache = None
+        self.shared_store = None
+        # Return rendered figures, rather than Figure objects
+        self.render_figures = False
 
         self.is_active = False
+        self.is_cancelled = False
 
     def start(self):
         """
@@ -400,30 +732,135 @@ class Job(QObject):
         self.is_active = False
         self.status = STATUS_COMPLETE
 
-    def next(self, kernel=None):
+    def ready(self):
         """
-        Return the next available Task object (kernel is ignored)
+        Return the list of queued Task objects that are ready to run
+
+        A Task is ready once all of its dependencies have completed. Tasks that depend
+        on an errored Task can never run, and are moved to the errored list.
         """
-        try:
-            e = self.tasks_queued.pop()
+        ready = []
+        for t in self.tasks_queued[:]:
+            if set(t.dependencies) & set(self.tasks_errored):
+                # A dependency has errored, we can't run this task (ever); add to error list and skip it
+                self.tasks_queued.remove(t)
+                self.tasks_errored.append(t)
 
-        except IndexError:  # Empty exec list
-            self.is_active = False
+            elif set(t.dependencies) & set(self.tasks_cancelled):
+                self.cancel_task(t)
+
+            elif t.ready():
+                ready.append(t)
+
+        return ready
+
+    def locality(self, task, kernel):
+        """
+        Return a tuple of (bytes of input data already on the kernel, total bytes of input data)
+        for running the given Task on the kernel. Used to select the best runner for the Task.
+        """
+        return 0, 0
+
+    def from_cache(self, task):
+        """
+        Satisfy as much of the Task as possible from the result cache, returning True
+        if nothing is left to run (the Task does not need a kernel)
+        """
+        return False
+
+    def dispatch(self, task, kernel=None):
+        """
+        Mark the given Task as running on the specified kernel, and return it
+        """
+        self.tasks_queued.remove(task)
+        self.tasks_running.append(task)
+        return task
+
+    def next(self, kernel=None):
+        """
+        Return the next available Task object for the kernel, False if waiting
+        on dependencies or None if there is nothing left to run
+        """
+        if not self.tasks_queued:
+            self.complete()
             return None
 
+        tasks = self.ready()
+        if not tasks:
+            return False  # Waiting
+
+        return self.dispatch(tasks[0], kernel)
+
+    def complete(self):
+        """
+        Job complete
+        """
+        self.is_active = False
+
+    def supersedes(self, job):
+        """
+        Return True if this job will (re)calculate everything the given job would
+        """
+        return bool(job.tool_list) and set(job.tool_list) <= set(self.tool_list)
+
+    def cancel_task(self, task):
+        """
+        Cancel a queued or running Task, notifying its Execute objects
+
+        Running Tasks must be stopped on the runner first (see Queue.cancel).
+        """
+        if task in self.tasks_queued:
+            self.tasks_queued.remove(task)
+        elif task in self.tasks_running:
+            self.tasks_running.remove(task)
         else:
-            self.tasks_running.append(e)
-            return e
+            return
+
+        self.tasks_cancelled.append(task)
+        for e in task.execute:
+            e.cancelled.emit()
+
+    def cancel(self):
+        """
+        Cancel the job; queued and running Tasks are cancelled, and the results of running Tasks discarded
+        """
+        self.is_cancelled = True
+        for task in self.tasks_queued + self.tasks_running:
+            self.cancel_task(task)
+        self.complete()
+
+    def tasks_for_tools(self, tools):
+        """
+        Return a list of (Task, n) for the queued and running Tasks that (re)calculate any of the
+        given tools, where n is the index of the first Execute in the Task to be cancelled
+        """
+        return []
+
+    def truncate_task(self, task, n):
+        """
+        Cancel the Executes of a queued or running Task from index n on, notifying them; the
+        earlier Executes still run. On a running Task the cancelled Executes run on the kernel
+        regardless (the Task is a single call), but their results are discarded.
+        """
+        cancelled = task.execute[n:]
+        if task in self.tasks_running:
+            for e in cancelled:
+                e.is_cancelled = True
+        else:
+            del task.execute[n:]
+
+        for e in cancelled:
+            e.cancelled.emit()
 
 
 class CodeJob(Job):
 
-    def __init__(self, code, language='python'):
-        super(CodeJob, self).__init__()
+    def __init__(self, code, language='python', *args, **kwargs):
+        super(CodeJob, self).__init__(*args, **kwargs)
 
         # Create a single code-object job and push it to the queue
         self.tasks_queued.append(
-            Task(self, execute=[Execute(code, language=language)])
+            Task(self, execute=[Execute(code=[code], language=language)])
         )
 
 
@@ -457,11 +894,13 @@ class ToolJob(Job):
     of an existing job, the existing job is deleted.
     """
 
-    def __init__(self, tool, varsi, *args, **kwargs):
+    def __init__(self, tool, varsi, use_cache=True, *args, **kwargs):
         """
-        Generate an execution queue from the supplied singular tool
+        Generate an execution queue from the supplied singular tool (or list of tools)
         current tool is in the head position, execution will start from there.
 
+        With use_cache False all tools are run, even if a result is cached (see from_cache).
+
         As passing each tool, lock the code and config into the tool ensure static
         for the whole of execution, ignore future changes.
 
@@ -480,157 +919,356 @@ class ToolJob(Job):
         #    }
 
         global_varsi = varsi.copy()
+        self.global_varsi = global_varsi
+        self.use_cache = use_cache
+        global_key = self.global_key(global_varsi)
+
+        # Build the execution plan:
+        #  - collect the tools downstream of the initiating tool (this, and all watchers)
+        #  - weight each by its historical runtime, and calculate the critical path (the
+        #    longest remaining chain of runtime from each tool to the end of the workflow)
+        #  - topologically sort (Kahn) always taking the ready tool with the longest critical path
+        #  - group linear chains of tools into single Tasks, starting a new Task at forks and joins
+        tools = self.collect_tools(tool)
+        in_job = set(tools)
+        all_parents = {}
+        parents = {}
+        children = {}
+        for t in tools:
+            # A parent may feed more than one interface
+            all_parents[t] = list(OrderedDict.fromkeys(t.get_parents()))
+            parents[t] = [p for p in all_parents[t] if p in in_job]
+            children[t] = []
+
+        for t in tools:
+            for p in parents[t]:
+                children[p].append(t)
 
-        # Build the queue of Exec objects;
-        self.execs_queue = []
+        critical_path = self.critical_path(tools, parents, children)
+        order = self.topological_order(tools, parents, children, critical_path)
+
+        # Build an Execute object for each tool in turn, extending the Task of the parent
+        # where this tool is the only watcher of a single parent (straight-line execution)
         self.exec_tool_lookup = {}
         tool_task_lookup = {}
+        result_keys = {}
+        for t in order:
+            e = self.build_execute(t)
+            # Store the tool for this Exec object; for dispatch calculation
+            self.exec_tool_lookup[e] = t
+
+            # Key the result on everything that goes into it (parents first, so keys chain)
+            result_keys[t] = self.result_key(t, e.varsi['config'], result_keys, global_key)
+            e.metadata['cache_key'] = result_keys[t]
+
+            is_chained = len(all_parents[t]) == 1 and len(parents[t]) == 1 and len(children[parents[t][0]]) == 1
+            if is_chained:
+                task = tool_task_lookup[parents[t][0]]
+                task.execute.append(e)
+
+            else:
+                # If this is the first execute object in the task update it with the global vars for run
+                e.varsi.update(global_varsi)
+                task = Task(self, execute=[e], dependencies=[tool_task_lookup[p] for p in parents[t]])
+                # Tasks are prioritised by the longest remaining chain from their head
+                task.priority = critical_path[t]
+                self.tasks_queued.append(task)
 
-        process_queue = [tool]
-        process_done = []
+            task.runtime += self.tool_runtime(t)
+            tool_task_lookup[t] = task
 
-        tool_list = []
-        exec_list = []
+        # Longest remaining chain first (sort is stable; otherwise topological)
+        self.tasks_queued.sort(key=lambda task: -task.priority)
 
-        previous_tool = None
+        logging.debug("task_queue: %s" % self.tasks_queued)
 
-        while len(process_queue) > 0:
+        self.tool_list = order
 
-            # Remove duplicates
-            process_queue = list(set(process_queue))
-            t = process_queue.pop(0)  # From front
+    @staticmethod
+    def collect_tools(tool):
+        """
+        Return the list of tools from the initiating tool (or tools) through the tree of
+        watchers, in order of discovery
+        """
+        tools = list(tool) if isinstance(tool, (list, tuple)) else [tool]
+        seen = set(tools)
+        for t in tools:  # Extended as we go
+            for w in [w.v for k, v in t.data.watchers.items() for w in v]:
+                if w not in seen:
+                    seen.add(w)
+                    tools.append(w)
 
-            # Check for what that this tool depends on
-            parents = t.get_parents()
+        return tools
 
-            if len(parents) > 0 \
-                and len( set(parents) & set(process_queue) ) > 0:
-                # waiting on something here, push to the back of the list for later
-                process_queue.append(t)
-                continue
+    @staticmethod
+    def tool_runtime(tool):
+        """
+        Return the expected runtime of a tool (in seconds) based on previous runs
+        """
+        runtime = getattr(tool, 'runtime', None)
+        return runtime if runtime is not None else DEFAULT_TOOL_RUNTIME
 
-            # Build an exec object for the given tool: note that at this point we cannot determine whether the
-            # vars are on the correct kernel. We can't seed at this point either, as the result of subsequent
-            # calculations will not be reflected. The solution is to populate Exec.varsi{} at runtime dispatch.
-            # In order to make the neccessary data available at that time, we here store it via lookup.
-            varsi = {
-                    'config': t.config.as_dict(),
-                    '_pathomx_tool_path': t.plugin.path,
-                    '_pathomx_expected_output_vars': list( t.data.o.keys() ),
-                    }
-
-            # Build the IO magic
-            # - if the source did not run on the current runner we'll need to push the data over (later)
-            io = {'input': {}, 'output': {}, }
-            for i, sm in t.data.i.items():
-                if sm:
-                    mo, mi = sm
-                    io['input'][i] = "_%s_%s" % (mi, id(mo.v))
-                else:
-                    io['input'][i] = None
-            for o in t.data.o.keys():
-                io['output'][o] = "_%s_%s" % (o, id(t))
-            varsi['_io'] = io
-
-
-            e = Execute(
-                varsi=varsi,
-                code=[
-                      "from pathomx.kernel_helpers import pathomx_notebook_start, pathomx_notebook_stop, progress, open_with_progress; pathomx_notebook_start(vars());",
-                      t.code,
-                      "pathomx_notebook_stop(vars());",
-                    ],
-                varso=['varso'],
-                language=t.language,
-                metadata={'name': t.name, 'tool': t },
-            )
-
-            e.progress.connect(t.progress.emit)
-            e.result.connect(t._worker_result_callback)
+    def critical_path(self, tools, parents, children):
+        """
+        Return a dict of the longest remaining chain of runtime from each tool to the end
+        of the workflow (inclusive of the tool itself)
+        """
+        # Reverse topological walk from the tools without children
+        n_children = {t: len(children[t]) for t in tools}
+        process_queue = [t for t in tools if n_children[t] == 0]
+        cp = {}
+        while process_queue:
+            t = process_queue.pop()
+            cp[t] = self.tool_runtime(t) + max([cp[c] for c in children[t]] or [0])
+            for p in parents[t]:
+                n_children[p] -= 1
+                if n_children[p] == 0:
+                    process_queue.append(p)
+
+        return cp
 
-            # Store the tool for this Exec object; for dispatch calculation
-            self.exec_tool_lookup[e] = tool
+    @staticmethod
+    def topological_order(tools, parents, children, weights):
+        """
+        Return the tools in dependency order (Kahn's algorithm)
 
+        Of the tools that are ready at each point the one heading the longest chain is
+        taken first; ties are broken by discovery order to keep the plan stable between runs.
+        """
+        index = {t: n for n, t in enumerate(tools)}
+        n_parents = {t: len(parents[t]) for t in tools}
+        ready = [(-weights[t], index[t], t) for t in tools if n_parents[t] == 0]
+        heapq.heapify(ready)
+
+        order = []
+        while ready:
+            _, _, t = heapq.heappop(ready)
+            order.append(t)
+            for c in children[t]:
+                n_parents[c] -= 1
+                if n_parents[c] == 0:
+                    heapq.heappush(ready, (-weights[c], index[c], c))
+
+        if len(order) != len(tools):
+            logging.error("Workflow contains a cycle; %d tool(s) will not be run" % (len(tools) - len(order)))
+
+        return order
+
+    def build_execute(self, t):
+        # Build an exec object for the given tool: note that at this point we cannot determine whether the
+        # vars are on the correct kernel. We can't seed at this point either, as the result of subsequent
+        # calculations will not be reflected. The solution is to populate Exec.varsi{} at runtime dispatch.
+        varsi = {
+                'config': t.config.as_dict(),
+                '_pathomx_tool_path': t.plugin.path,
+                '_pathomx_expected_output_vars': list( t.data.o.keys() ),
+                '_pathomx_expected_view_vars': None if t.view_vars is None else list( t.view_vars ),
+                }
+
+        # Build the IO magic
+        # - if the source did not run on the current runner we'll need to push the data over (later)
+        io = {'input': {}, 'output': {}, }
+        for i, sm in t.data.i.items():
+            if sm:
+                mo, mi = sm
+                io['input'][i] = "_%s_%s" % (mi, id(mo.v))
+            else:
+                io['input'][i] = None
+        for o in t.data.o.keys():
+            io['output'][o] = "_%s_%s" % (o, id(t))
+        varsi['_io'] = io
+
+        e = Execute(
+            varsi=varsi,
+            code=[
+                  "pathomx_notebook_start(vars());",
+                  t.code,
+                  "pathomx_notebook_stop(vars());",
+                ],
+            varso=['varso'],
+            language=t.language,
+            # The outputs remain on the kernel after the run
+            metadata={'name': t.name, 'tool': t, 'resident': {n: t for n in io['output'].values()}},
+        )
 
-            watchers = [w.v for k, v in t.data.watchers.items() for w in v]
-            for w in watchers:
-                if w not in process_done and w not in process_queue:
-                    # Put all watchers at the front of the list, this will iteratively ensure we can straight-line
-                    # down at least one path once started
-                    process_queue.insert(0, w)
+        e.progress.connect(t.progress.emit)
+        e.progress_info.connect(t.progress_info.emit)
+        e.result.connect(lambda result, e=e: self.store_result(e, result))
+        e.result.connect(t._worker_result_callback)
+        e.cancelled.connect(t._worker_cancelled_callback)
 
+        return e
 
-            # Determine the position of the object
-            # Is before fork; if there is more than 1 tool watching this one
-            is_before_fork = len(watchers) > 1
-            # Is the end of a fork (watchers have > 1 parent)
-            is_end_of_fork = len([p for w in watchers for p in w.get_parents()]) > 1
+    @staticmethod
+    def global_key(varsi):
+        """
+        Return a hash of the global vars (rcParams, styles) passed to every tool in a job; figures
+        (so results) depend on them. Styles are hashed by their definition, as saved in workflows.
+        """
+        h = hashlib.sha1()
+        for k, v in sorted(varsi.items()):
+            if hasattr(v, 'getXMLMatchDefinitionsStyles'):
+                s = et.Element('Styles')
+                v.getXMLMatchDefinitionsStyles(s)
+                v = et.tostring(s)
+            elif isinstance(v, dict):
+                v = sorted(v.items())
+            h.update(('%s=%r' % (k, v)).encode('utf8'))
+
+        return h.hexdigest()
 
+    @staticmethod
+    def result_key(t, config, result_keys, global_key=''):
+        """
+        Return a key uniquely identifying the result of running the tool with the given config
+
+        The key is a hash of the tool code, config and plugin version and the global vars (as
+        global_key, see above), plus the key of the result
+        on each input. For inputs calculated in this job that is the key calculated here, so the keys
+        chain down the workflow without needing the data. For inputs from outside the job it is the
+        key of the source tool's current result if known, otherwise a fingerprint of the data itself.
+        Config values referring to files include the file size and modification time, so changes
+        to files on disk are picked up.
+        """
+        h = hashlib.sha1()
+        h.update(t.code.encode('utf8'))
+        h.update(('%s' % t.plugin.metadata.get('version')).encode('utf8'))
+        h.update(global_key.encode('utf8'))
+
+        for k, v in sorted(config.items()):
+            h.update(('%s=%r' % (k, v)).encode('utf8'))
+            try:
+                if isinstance(v, (str, type(u''))) and os.path.isfile(v):
+                    st = os.stat(v)
+                    h.update(('%d:%d' % (st.st_size, st.st_mtime)).encode('utf8'))
+            except Exception:
+                pass
+
+        for i, sm in sorted(t.data.i.items()):
+            if sm:
+                mo, mi = sm
+                source = mo.v
+                if source in result_keys:
+                    key = result_keys[source]
+                elif getattr(source, 'result_key', None) is not None:
+                    key = source.result_key
+                else:
+                    key = transport.fingerprint(mo.o[mi])
+                h.update(('%s<%s:%s' % (i, mi, key)).encode('utf8'))
+            else:
+                h.update(('%s<None' % i).encode('utf8'))
 
-            if previous_tool is not None and previous_tool not in parents:
-                # We are not a direct descendant we're going to have to start a new Task.
-                # There should be more effort to mitigate this in ordering of the task-queue
-                task = Task(self, execute=exec_list)
-                self.tasks_queued.append(task)
+        return h.hexdigest()
 
-                for pt in tool_list:
-                    tool_task_lookup[pt] = task
+    def store_result(self, e, result):
+        """
+        Store a successful result in the cache, and record the key of the current result on the tool
+        """
+        tool = e.metadata['tool']
+        if result['status'] != 0:
+            tool.result_key = None
+            return
 
-                exec_list = []
-                tool_list = []
+        tool.result_key = e.metadata['cache_key']
+        if self.cache is not None and not result.get('cached'):
+            self.cache.put(e.metadata['cache_key'], result['varso'], tag=id(tool))
 
-            # If this is the first execute object in the queue (list is empty), update it with the global vars for run
-            # and store the head of branch tool for later dependencies
-            if not exec_list:
-                e.varsi.update( global_varsi )
+    def tasks_for_tools(self, tools):
+        # Including everything downstream of the tools; which depends on their results. A chained
+        # Task may start with tools upstream of these, which are kept
+        downstream = set()
+        for t in tools:
+            if t in self.tool_list:
+                downstream |= set(self.collect_tools(t))
 
-            tool_list.append(t)
-            exec_list.append(e)
+        tasks = []
+        for task in self.tasks_queued + self.tasks_running:
+            for n, e in enumerate(task.execute):
+                if e.metadata and e.metadata.get('tool') in downstream:
+                    tasks.append((task, n))
+                    break
 
-            if is_before_fork or is_end_of_fork:
-                # We've got >1 children, we need to create a split task again
-                task = Task(self, execute=exec_list)
-                self.tasks_queued.append(task)
+        return tasks
 
-                for pt in tool_list:
-                    tool_task_lookup[pt] = task
+    def start(self):
+        if not self.is_active:
+            # Reset all tools in this Job to clear-status (not ready)
+            for t in self.tool_list:
+                t.status.emit('ready')
 
-                exec_list = []
-                tool_list = []
+        super(ToolJob, self).start()
 
-            process_done.append(t)
-            previous_tool = t
+    def input_data(self, task):
+        """
+        Yield (interface, source interface, source tool, data) for each input of the head of the Task
 
-        if exec_list: # Remainders
-            task = Task(self, execute=exec_list)
-            self.tasks_queued.append( task )
+        We only need to get inputs for the head Execution; as the branching logic means
+        that anywhere with >1 parent == a new Task, the remainder are fed within the Task.
+        """
+        if not task.execute:
+            return
 
-        logging.debug("task_queue: %s" % self.tasks_queued)
+        tool = task.execute[0].metadata['tool']
+        for i, sm in tool.data.i.items():
+            if sm:
+                mo, mi = sm
+                yield i, mi, mo.v, mo.o[mi]
+
+    def locality(self, task, kernel):
+        resident, total = 0, 0
+        for i, mi, source, data in self.input_data(task):
+            size = utils.data_size(data)
+            total += size
+            if id(kernel) in source.current_data_on_kernels:
+                resident += size
+            else:
+                # Data in the shared store is mapped by any kernel, without a transfer
+                ref = source.shared_refs.get(mi)
+                if ref is not None and ref.exists():
+                    resident += size
+
+        return resident, total
+
+    def from_cache(self, task):
+        """
+        Short-circuit Executes at the head of the Task that have a cached result
 
+        The cached results are passed to the tools as if they had been run. Only the head of
+        the Task is checked; once a tool must be run, all tools downstream of it in the Task
+        must be also (their input keys chain from it). The data for cached tools is only
+        held locally, so is pushed to the kernel as required on dispatch.
+        """
+        if self.cache is None or not self.use_cache:
+            return False
 
-        # Apply the dependencies to each task: we need to do this at the end to avoid missing due to order
-        for t in self.tasks_queued:
-            if t.execute:
-                e0 = t.execute[0]
-                dependencies = []
-                for ti in e0.metadata['tool'].get_parents():
-                    if ti in tool_task_lookup:
-                        dependencies.append( tool_task_lookup[ti] )
-                t.dependencies = dependencies
+        is_stripped = False
+        while task.execute:
+            e = task.execute[0]
+            key = e.metadata.get('cache_key') if e.metadata else None
+            varso = self.cache.get(key) if key else None
+            if varso is None:
+                break
 
-        self.tool_list = process_done
+            logging.debug("Using cached result for %s" % e.metadata['name'])
+            task.execute.pop(0)
+            is_stripped = True
+            e.result.emit({
+                'status': 0,
+                'varso': varso,
+                'stdout': '',
+                'kernel': None,  # Not on any kernel
+                'cached': True,
+            })
 
-    def start(self):
-        if not self.is_active:
-            # Reset all tools in this Job to clear-status (not ready)
-            for t in self.tool_list:
-                t.status.emit('ready')
+        if is_stripped and task.execute:
+            # The global vars must be passed at the start of the Task (see __init__)
+            task.execute[0].varsi.update(self.global_varsi)
 
-        super(ToolJob, self).start()
+        return not task.execute
 
-    def next(self, kernel=None):
+    def dispatch(self, task, kernel=None):
         """
-        Request the next Task object to run on the specified kernel
+        Prepare the Task to run on the specified kernel
 
         The provided kernel identifier is used to determine whether the
         parent tools' data must be sent through before execution. For
@@ -640,31 +1278,9 @@ class ToolJob(Job):
         yet, or last, run. In this case the data must be passed over before
         in the variable in.
 
-        The passing should be logged, and (post-send?) the tool updated to
+        The passing is logged, and (post-send) the tool updated to
         reflect that it's data is now *also* on the other kernel.
-
-        ? callback on the vars push ?
-
         """
-        if not self.tasks_queued:
-            self.complete()
-            return None
-
-        for t in self.tasks_queued[:]:
-            if not t.dependencies or len( set(t.dependencies) - set(self.tasks_complete) ) == 0:
-                # We have an Exec not waiting on dependencies
-                # Remove this task from the queue then continue on
-                self.tasks_queued.remove(t)
-                break
-
-            if set(t.dependencies) & set(self.tasks_errored):
-                # A dependency has errored, we can't run this task (ever); add to error list and skip it
-                self.tasks_queued.remove(t)
-                self.tasks_errored.append(t)
-
-        else:
-            return False # Waiting
-
         # Handle the exec here
         # We receive the kernel identifier from the Queue, so here we can determine whether the parent(s)
         # tools were run on the same kernel. There are two scenarios here:
@@ -672,55 +1288,47 @@ class ToolJob(Job):
         #   - 2. Fork parallel job, needs feeding in to continue
         #
         # Note, we need to ensure we are sending up-to-date data (i.e. the previous Exec has finished, and results
-        # have been exported before we start on with the next). This locking can be achieved using the Exec dependencies.
-
-        # Check whether the parents of the head-of-queue were run on this kernel
-        # Get the original tool; build a list of all parents + their respective kernels
+        # have been exported before we start on with the next). This locking is achieved using the Task dependencies.
 
-        # Iterate each, find if it's current data is on *this* kernel, if so carry on
+        # Iterate each parent, find if it's current data is on *this* kernel, if so carry on
         # if not, we'll need to pass it in (can stuff it into the first Exec, or add a new one?)
         varsi = {}
+        resident = {}
         tools_to_move = []
-        # Apply the dependencies to each task: we need to do this at the end to avoid missing due to order
-        if t.execute:
-            # We only need to get dependencies for the head Execution; as the branching logic means that >1 parent
-            # anywhere >1 parent == a new Task
-            e0 = t.execute[0]
-            tool = e0.metadata['tool']
-            # Build the dict to send,
-            # will also want to build some kind of callback to track this
-            for i, sm in tool.data.i.items():
-                if sm:
-                    mo, mi = sm
-
-                    if id(kernel) not in mo.v.current_data_on_kernels:
-                        # We need to push the actual data; this should do it?
-                        varsi['_%s_%s' % (mi, id(mo.v)) ] = tool.data.get(i)
-                        tools_to_move.append( mo.v )
+        for i, mi, source, data in self.input_data(task):
+            if id(kernel) not in source.current_data_on_kernels:
+                name = '_%s_%s' % (mi, id(source))
+                ref = source.shared_refs.get(mi)
+                if ref is not None and ref.exists():
+                    # The data is in the shared store, the kernel can map it from there
+                    varsi[name] = ref
+                else:
+                    # We need to push the actual data
+                    varsi[name] = task.execute[0].metadata['tool'].data.get(i)
+                resident[name] = source
+                tools_to_move.append( source )
+
+        if self.shared_store is not None:
+            # Kernels write their large outputs (and optionally rendered figures) to the shared store
+            for e in task.execute:
+                if e.varsi is not None:
+                    e.varsi['_pathomx_shared_store'] = self.shared_store.path
+                    e.varsi['_pathomx_render_figures'] = self.render_figures
 
         # We've got something to move between kernels
         if varsi:
-            e = Execute(varsi=varsi)
-            # FIXME: This will need a callback wrapped function to pass the extra data without some nasty shit
+            e = Execute(varsi=varsi, metadata={'name': 'data', 'resident': resident})
             e.complete.connect(lambda: self.complete_move_data_to_kernel(kernel, tools_to_move))
             # Put this Execute instruction at the head of list
-            t.execute.insert(0, e)
-
-        self.tasks_running.append(t)
-        return t
+            task.execute.insert(0, e)
 
+        return super(ToolJob, self).dispatch(task, kernel)
 
     @staticmethod
     def complete_move_data_to_kernel(kernel, tools):
         for t in tools:
             t.current_data_on_kernels.add(id(kernel))
 
-    def complete(self):
-        """
-        Job complete
-        """
-        pass
-
 
 
 
@@ -741,28 +1349,202 @@ class Queue(QObject):
         super(Queue, self).__init__()
 
         self.runners = []
-        self.jobs = []  # Job queue a tuple of (notebook, success_callback, error_callback)
+        self.jobs = []  # Jobs in order of submission; see ordered_jobs for the order they are run
+        self._job_seq = 0
+
+        # Smoothed time (seconds) jobs wait for a runner, for display
+        self.wait_time = 0
 
         self.start.connect(self.run)
 
-        self.p = None
-        self.client = None
+        # Execution backend (see backends.BACKENDS); started by create_runners
+        self.backend_name = 'cluster'
+        self.backend = None
+
+        self.cache = ResultCache()
+        self.shared_store = transport.SharedStore()
+        self.render_figures = False
+
+        # Modules to import on each kernel as it starts
+        self.warm_up_modules = []
+
+        # Maximum number of engines (0 for the default; see default_engine_count)
+        self.max_engines = 0
+        # Number of engines started (including those not yet registered)
+        self.engines_expected = 0
+        # Idle engines using more memory than this (bytes) are restarted (0 for no limit)
+        self.engine_memory_limit = 0
 
     def start_timers(self):
         self._run_timer = QTimer()
         self._run_timer.timeout.connect(self.run)
-        self._run_timer.start(100)  # Auto-check for pending jobs every 0.1 second; this shouldn't be needed but some jobs get stuck(?)
+        self._run_timer.start(1000)  # Fallback check for pending jobs; dispatch is triggered on add and on task completion
 
         self._cluster_timer = QTimer()
         self._cluster_timer.timeout.connect(self.create_runners)
         self._cluster_timer.start(5000)  # Re-check runners every 5 seconds
 
+        # Fallback check of running tasks, in case a socket notification is missed;
+        # only runs while there is something running (see check_runners)
+        self._watchdog_timer = QTimer()
+        self._watchdog_timer.timeout.connect(self.check_runners)
+
+    def check_runners(self):
+        """
+        Check the status and progress of all active runners
+
+        Called on any activity on the backend, and by the watchdog timer while any
+        runner is active. On completion of tasks the queue is re-run immediately so
+        that dependent tasks start without waiting.
+        """
+        if self.backend is not None:
+            # Collect anything waiting (when called from the watchdog)
+            self.backend.spin()
+
+        completed = False
+        for runner in self.runners:
+            runner.check_progress()
+            if runner.check_status():
+                completed = True
+
+        if completed:
+            self.refresh_queue_status()
+            self.run()
+
+        if self.no_of_active_kernels > 0:
+            if not self._watchdog_timer.isActive():
+                self._watchdog_timer.start(1000)
+        else:
+            self._watchdog_timer.stop()
+
+    def refresh_queue_status(self):
+        # Update the number of messages queued on each engine (in a single hub query)
+        if self.backend is None:
+            return
+
+        queue_status = self.backend.queue_status()
+        for runner in self.runners:
+            if runner.k in queue_status:
+                runner.queue_length = queue_status[runner.k]
+
     def add(self, job):
+        # If the new job is a superset of an existing job, the existing job is stale; any results
+        # would be immediately replaced, so drop it (and abort running tasks) so we only calculate
+        # the latest configuration. Jobs with all tasks dispatched are no longer queued, but
+        # their running tasks are stale all the same
+        for j in self.active_jobs():
+            if job.supersedes(j):
+                self.cancel(j)
+
+        job.cache = self.cache
+        job.shared_store = self.shared_store
+        job.render_figures = self.render_figures
+        job.seq = self._job_seq
+        job.waiting_since = time.time()
+        self._job_seq += 1
         self.jobs.append(job)
 
         # We fire an additional
         self.start.emit()
 
+    def active_jobs(self):
+        """
+        Return the queued jobs plus any jobs with Tasks still running (which are no longer queued)
+        """
+        jobs = self.jobs[:]
+        for runner in self.runners:
+            if runner.task is not None and runner.task.job not in jobs:
+                jobs.append(runner.task.job)
+        return jobs
+
+    def cancel(self, job):
+        """
+        Cancel the given job, dropping it from the queue and stopping any of its running tasks
+        """
+        logging.debug("Cancelling job %s" % id(job))
+        for runner in self.runners:
+            if runner.task is not None and runner.task.job is job:
+                runner.cancel()
+
+        job.cancel()
+        if job in self.jobs:
+            self.jobs.remove(job)
+
+    def cancel_tool(self, tool):
+        """
+        Cancel the calculation of the given tool, and of the tools downstream of it, in all jobs
+
+        Other branches of the jobs continue. Runners stopped are released immediately.
+        """
+        for job in self.active_jobs():
+            tasks = job.tasks_for_tools([tool])
+            if not tasks:
+                continue
+
+            logging.debug("Cancelling %d tasks of job %s for %s" % (len(tasks), id(job), tool.name))
+            for task, n in tasks:
+                if any([e.metadata.get('tool') for e in task.execute[:n] if e.metadata]):
+                    # Tools upstream of this one in the same Task continue
+                    job.truncate_task(task, n)
+                    continue
+
+                for runner in self.runners:
+                    if runner.task is task:
+                        runner.cancel()
+
+                job.cancel_task(task)
+
+        # Runners may have been freed
+        self.start.emit()
+
+    def interrupt(self):
+        """
+        Cancel all jobs, stopping all running tasks
+        """
+        for job in self.active_jobs():
+            self.cancel(job)
+
+    def set_warm_up_modules(self, modules):
+        """
+        Set the modules imported on each kernel as it starts; any new modules are also
+        imported on the existing kernels
+        """
+        new_modules = [m for m in modules if m not in self.warm_up_modules]
+        self.warm_up_modules = modules
+        if new_modules:
+            for runner in self.runners:
+                runner.warm_up(new_modules)
+
+    @staticmethod
+    def effective_priority(job, now):
+        # Priority increases the longer a job waits for a runner
+        return job.priority + int((now - job.waiting_since) // JOB_AGING_INTERVAL)
+
+    def ordered_jobs(self):
+        """
+        Return the jobs in the order they should be given runners: highest (effective) priority
+        first, then in order of submission
+        """
+        now = time.time()
+        return sorted(self.jobs, key=lambda j: (-self.effective_priority(j, now), j.seq))
+
+    @property
+    def no_of_tasks_queued(self):
+        return sum([len(j.tasks_queued) for j in self.jobs])
+
+    @property
+    def no_of_tasks_ready(self):
+        # Queued Tasks whose dependencies have completed (without the side effects of Job.ready)
+        return sum([len([t for t in j.tasks_queued if t.ready()]) for j in self.jobs])
+
+    @property
+    def longest_wait(self):
+        """
+        Time (seconds) the longest-waiting job has waited for a runner
+        """
+        now = time.time()
+        return max([now - j.waiting_since for j in self.jobs] or [0])
+
     @property
     def no_of_kernels(self):
         return len(self.runners)
@@ -771,113 +1553,268 @@ class Queue(QObject):
     def no_of_active_kernels(self):
         return sum([1 if k.is_active else 0 for k in self.runners])
 
+    def select_runner(self, job, task):
+        """
+        Select the best runner for the given Task, or None if it should wait
+
+        Idle runners are scored by the number of bytes of the Task's input data that
+        are already resident on their kernel, so data is not pushed between kernels
+        unnecessarily. If a large amount of data would need to be moved and a busy
+        runner (running one of our tasks; so it will be free soon) holds more of it,
+        we wait for that runner instead; unless from the runtime of previous runs that
+        runner is not expected to finish before the data could have been pushed, or it has
+        already overrun its expected runtime. Data in the shared store counts as resident
+        on every runner, as any kernel can map it.
+        """
+        idle = [r for r in self.runners if not r.is_active]
+        if not idle:
+            return None
+
+        resident = {}
+        total = 0
+        for r in self.runners:
+            resident[r], total = job.locality(task, r.k)
+
+        runner = max(idle, key=lambda r: resident[r])
+
+        missing = total - resident[runner]
+        if missing > LOCALITY_WAIT_BYTES:
+            transfer_time = float(missing) / TRANSFER_BYTES_PER_SECOND
+            busy = [r for r in self.runners if r.status == STATUS_RUNNING and resident[r] > resident[runner] and
+                    not r.is_overdue() and r.remaining_runtime() < transfer_time]
+            if busy:
+                return None
+
+        return runner
+
     def run(self):
+        """
+        Dispatch all runnable Tasks from the queued jobs to idle runners
+
+        Every ready (dependency-free) Task of every job is handed out in a single pass,
+        until we run out of ready Tasks or idle runners. Independent branches of a job
+        therefore run in parallel. This is triggered on adding a job and on completion
+        of any Task, so there is no need to wait for a timer to continue dispatch.
+        """
 
         # Check for jobs
         if not self.jobs:
             return False
 
-        logging.info('Currently %d jobs remaining' % len(self.jobs))
+        dispatched = 0
+        for job in self.ordered_jobs():
 
-        job = self.jobs.pop()  # Get the job at the front of the queue
-        # (? can we be more intelligent about this is there are a lot of runners available)
+            # Initialise the job (this is a no-op if already running)
+            job.start()
 
-        # Identify the best runner for the job
-        # - which runners are available
-        # - which runners were the source data generated on
-        # - which source(s) have the largest data size
-        for runner in self.runners:
-            if not runner.is_active:
-                # That'll do for now
+            if not job.tasks_queued:
+                # Job has nothing left to dispatch; let it go (running Tasks keep their own reference)
+                self.jobs.remove(job)
+                job.complete()
+                continue
+
+            ready = job.ready()
+            if not ready:
+                # Waiting on its own running tasks, not for a runner
+                job.waiting_since = time.time()
+            seen = set(ready)
+            while ready:
+                task = ready.pop(0)
+
+                if job.from_cache(task):
+                    # Everything in this task was cached; it completes without a runner, which
+                    # may make further tasks ready
+                    job.dispatch(task)
+                    task.complete.emit()
+                    dispatched += 1
+
+                    for t in job.ready():
+                        if t not in seen:
+                            seen.add(t)
+                            ready.append(t)
+                    continue
+
+                # Identify the best runner for the task
+                # - which runners are available
+                # - which runners were the source data generated on
+                # - which source(s) have the largest data size
+                runner = self.select_runner(job, task)
+
+                if runner is None:
+                    # Can't run this task now, we'll have to wait
+                    continue
+
+                # Get the details for the execution step, preparing for the selected runner
+                e = job.dispatch(task, kernel=runner.k)
+
+                # If we're here, we've got an Exec object in e, that is good to go on the current runner
+                runner.run(e)
+                dispatched += 1
+
+                # The job has a runner; aging restarts from here
+                now = time.time()
+                self.wait_time = 0.8 * self.wait_time + 0.2 * (now - job.waiting_since)
+                job.waiting_since = now
+
+            if self.no_of_active_kernels == self.no_of_kernels:
+                # No runners left to give tasks to
                 break
-        else:
-            # Can't run now, we'll have to wait
-            self.jobs.insert(0, job)
-            return False
 
-        # Initialise the job (this is a no-op if already running)
-        job.start()
+        if dispatched:
+            logging.info('Dispatched %d tasks; currently %d jobs remaining' % (dispatched, len(self.jobs)))
 
-        # Get the details for the next execution step
-        e = job.next(kernel=runner.k)
+            # Start the watchdog (we'll be notified of completion through the backend)
+            if not self._watchdog_timer.isActive():
+                self._watchdog_timer.start(1000)
 
-        if e is False:
-            # Job is waiting on something to complete; wait and trigger a post-poned fire of self.run()
-            self.jobs.insert(0, job)
-            return False
+        return dispatched > 0
+
+    def restart(self):
+        # The cluster is started again on the next check (see create_runners)
+        self.stop_cluster()
+
+    @property
+    def engine_limit(self):
+        return self.max_engines if self.max_engines > 0 else default_engine_count()
+
+    def start_cluster(self):
+        # Start the backend; the number of engines is then adjusted to the workload (see scale_engines)
+        n = self.engine_limit
+        self.engines_expected = n
+        logging.info("Starting %s backend with %d engines" % (self.backend_name, n))
+        self.backend = BACKENDS[self.backend_name]()
+        self.backend.activity.connect(self.check_runners)
+        self.backend.start(n)
+
+    def start_engines(self, n):
+        # Start additional engines (picked up by create_runners once ready)
+        logging.info("Starting %d additional engines" % n)
+        self.backend.start_engines(n)
+        self.engines_expected += n
+
+    def stop_engine(self, runner):
+        """
+        Detach the given (idle) runner and shut down its engine
+        """
+        logging.info("Stopping %s" % runner.k.name)
+        self.runners.remove(runner)
+        runner.release_data()
+        self.engines_expected -= 1
+        self.backend.stop_engine(runner.k)
 
-        elif e is None:
-            # Job has completed; let it go
+    def scale_engines(self):
+        """
+        Start or stop engines to match the workload
+
+        Engines are added while there are more ready Tasks than idle runners, up to the engine
+        limit and as far as available memory allows (judged by the memory use of the running
+        engines). Idle engines are stopped when over the limit, when there is not enough memory
+        available for another engine (largest first), or when unused for ENGINE_IDLE_TIMEOUT.
+        """
+        limit = self.engine_limit
+        pending = max(0, self.engines_expected - len(self.runners))
+        idle = [r for r in self.runners if not r.is_active]
+        queued = self.no_of_tasks_queued
+        # Tasks waiting on dependencies can't use another engine yet
+        ready = self.no_of_tasks_ready
+
+        rss = [r.rss for r in self.runners if r.rss]
+        engine_memory = max(float(sum(rss)) / len(rss), 1) if rss else ENGINE_MEMORY
+        available = utils.available_memory()
+
+        wanted = min(ready - len(idle) - pending, limit - self.engines_expected)
+        if available is not None:
+            wanted = min(wanted, int(available // engine_memory))
+
+        if wanted > 0:
+            self.start_engines(wanted)
             return
 
-        else:
-            # If we're here, we've got an Exec object in e, that is good to go on the current runner
-            runner.run(e)
+        if not idle or pending or len(self.runners) <= 1:
+            return
 
-            # Might not be finished yet
-            self.jobs.insert(0, job)
+        if self.engines_expected > limit:
+            self.stop_engine(idle[0])
 
-    def restart(self):
-        self.stop_cluster()
+        elif available is not None and available < engine_memory and len([r for r in idle if r.rss]):
+            self.stop_engine(max([r for r in idle if r.rss], key=lambda r: r.rss))
 
-    def interrupt(self):
-        self.runner.interrupt_kernel()
-        
-    def start_cluster(self):
-        # Start IPython ipcluster with 4 engines
-        self.p = Popen([sys.executable, ipclusterapp.__file__, 'start', '--n=4'], stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+        elif queued == 0 and len(self.runners) > min(IDLE_ENGINES, limit):
+            runner = min(idle, key=lambda r: r.idle_since)
+            if time.time() - runner.idle_since > ENGINE_IDLE_TIMEOUT:
+                self.stop_engine(runner)
 
     def stop_cluster(self):
-        # Stop the ipcluster
-        p = Popen([sys.executable, ipclusterapp.__file__, 'stop'], stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
-        while p.poll() is None:  # Wait for the above to exit
-            pass
+        # Nothing will complete; tools are notified their calculations are cancelled
+        self.interrupt()
+        self.runners = []
+
+        if self.backend:
+            self.backend.stop()
+            self.backend = None
+
+        self.engines_expected = 0
 
-        self.p = None
-        if self.client:
-            self.client.shutdown()
-            self.client = None
+        # The shared store is kept: tools (and the result cache) still hold proxies to the data
+        # there, which outlives the engines that wrote it. It is cleared on shutdown
 
-    def terminate_cluster(self):
-        if self.p:
-            self.p.terminate()
-            self.p = None
+    def shutdown(self):
+        """
+        Stop the cluster and remove the shared store; on application exit
+        """
+        self.stop_cluster()
+        # Nothing is left to use the data (anything mapped remains available)
+        self.shared_store.clear()
 
     def create_runners(self):
-        # Check the status of runners and the cluster process
-        # If cluster process dead (non-None return to p.poll)
-        # kill and re-start (add config for this?) and then
-        # create an in-process kernel and pop it on the queue
-        # to keep things ticking
-
-        if self.p is None:
-            # Use the in-process runner for now
-            # self.runners = [self.in_process_runner]
+        # Check the status of runners and the backend; start the backend if not
+        # running, or restart it if it has failed (on the next check)
+
+        if self.backend is None:
             self.start_cluster()
 
-        elif self.p.poll() is None:
-            # Create matching runners for the client
+        elif self.backend.is_alive():
+            # Create matching runners for the kernels
             # note that these may already exist; we need to check
-            if self.client is None:
-                self.client = Client(timeout=5)
-
-            for k in self.client:
-                found = False
-                for r in self.runners:
-                    if k.targets == r.k.targets:
-                        found = True
-
-                if not found:
+            kernels = self.backend.kernels()
+            if kernels is None:
+                # Not ready yet
+                return
+
+            # Engines that have gone (or been stopped) are no longer listed
+            for r in self.runners[:]:
+                if r.k not in kernels and not r.is_active:
+                    self.runners.remove(r)
+                    r.release_data()
+                    self.engines_expected -= 1
+
+            for k in kernels:
+                if not any(r.k is k for r in self.runners):
                     runner = Runner(k)
-                    runner.k.execute('%reset -f')
-                    runner.k.execute('%matplotlib inline')
-                    runner.k.apply(use_dill)
+                    if self.warm_up_modules:
+                        # Runs in parallel on all new kernels (we don't wait)
+                        runner.warm_up(self.warm_up_modules)
                     self.runners.append(runner)
 
+            self.refresh_queue_status()
+
+            for r in self.runners[:]:
+                if r.is_active:
+                    r.update_memory()
+                    continue
+
+                r.evict_stale()
+                if self.engine_memory_limit and (r.update_memory() or 0) > self.engine_memory_limit:
+                    # Memory freed on the engine is not necessarily returned to the system, so restart it;
+                    # the data it held is sent to other kernels as needed (from the shared store, if there)
+                    logging.info("%s is using %d MB; restarting" % (r.k.name, r.rss // (1024 * 1024)))
+                    self.stop_engine(r)
+                    self.start_engines(1)
 
+            self.scale_engines()
 
         else:
-            # We've got a -value for poll; it's terminated this will trigger restart on next poll
+            # The backend has failed; this will trigger restart on next poll
             self.stop_cluster()
 
 
@@ -0,0 +1,383 @@
+from __future__ import unicode_literals
+import os
+import glob
+import uuid
+import shutil
+import tempfile
+from copy import deepcopy
+
+import numpy as np
+import pandas as pd
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .utils import data_size, data_fingerprint
+
+from IPython.utils import pickleutil
+from IPython.utils.pickleutil import CannedObject, CannedArray
+
+# Transport of numeric data between the GUI and the cluster engines
+#
+# IPython.parallel sends numpy arrays as raw buffers (separate zmq frames, no pickling), but
+# anything else is pickled whole; including pandas DataFrames and Series, which is how nearly
+# all data in Pathomx is held. Here we register 'canners' for DataFrame and Series which
+# send the values the same way as numpy arrays, with only the index and columns pickled.
+# On receipt the values are wrapped without copying (frombuffer), so are read-only.
+#
+# register() must be called in the GUI process and on each engine (for pull).
+#
+# All engines run on the same host as the GUI, so large outputs are also written once to a
+# host-local shared store (SharedStore; in /dev/shm where available) by the engine that
+# calculated them. Only a small reference (SharedRef) is then passed around; any other engine
+# maps the data read-only from the store rather than receiving a copy. The GUI receives a
+# DataProxy, holding a summary of the data, and only maps the data when it is needed.
+
+# Arrays smaller than this are left in the pickle
+NPY_MIN_BYTES = 64 * 1024
+
+# Objects smaller than this are passed directly, rather than through the shared store
+SHARED_MIN_BYTES = 1024 * 1024
+
+
+def _can_values(values):
+    """
+    Return a (canned values, shape, dtype, transposed) tuple, or None if the values cannot
+    be sent as a buffer (object dtype)
+    """
+    if not isinstance(values, np.ndarray) or values.dtype == object or values.dtype.fields or values.size == 0:
+        return None
+
+    # DataFrame values are stored transposed (column-major); sending the transpose
+    # avoids making a contiguous copy
+    transposed = values.ndim == 2 and values.flags.f_contiguous and not values.flags.c_contiguous
+    if transposed:
+        values = values.T
+
+    values = np.ascontiguousarray(values)
+    # Flat bytes, so the buffer length is the size in bytes regardless of dtype/shape
+    return CannedArray(values.reshape(-1).view(np.uint8)), values.shape, values.dtype.str, transposed
+
+
+def _uncan_values(canned, shape, dtype, transposed):
+    values = canned.get_object().view(dtype).reshape(shape)
+    if transposed:
+        values = values.T
+    return values
+
+
+class CannedPandas(CannedObject):
+
+    def __init__(self, obj, canned_values):
+        self._values, self.shape, self.dtype, self.transposed = canned_values
+        self.index = obj.index
+        self.name = getattr(obj, 'name', None)
+        self.columns = getattr(obj, 'columns', None)
+
+        # Share the buffer list with the canned values; the IPython serializer extracts
+        # (and restores) buffers of the top-level canned object in place
+        self.buffers = self._values.buffers
+        self.hook = None
+
+    def values(self):
+        return _uncan_values(self._values, self.shape, self.dtype, self.transposed)
+
+
+class CannedDataFrame(CannedPandas):
+
+    def get_object(self, g=None):
+        return pd.DataFrame(self.values(), index=self.index, columns=self.columns, copy=False)
+
+
+class CannedSeries(CannedPandas):
+
+    def get_object(self, g=None):
+        return pd.Series(self.values(), index=self.index, name=self.name, copy=False)
+
+
+def can_dataframe(obj):
+    if len(set(obj.dtypes)) != 1:
+        # Mixed types are held in multiple blocks; getting values would copy, so just pickle
+        return obj
+
+    canned_values = _can_values(obj.values)
+    if canned_values is None:
+        return obj
+
+    return CannedDataFrame(obj, canned_values)
+
+
+def can_series(obj):
+    canned_values = _can_values(obj.values)
+    if canned_values is None:
+        return obj
+
+    return CannedSeries(obj, canned_values)
+
+
+def register():
+    """
+    Register the buffer transport for pandas objects with the IPython serializer
+    """
+    pickleutil.can_map[pd.DataFrame] = can_dataframe
+    pickleutil.can_map[pd.Series] = can_series
+
+
+def dump(obj, path, prefix, min_bytes=NPY_MIN_BYTES):
+    """
+    Pickle obj to <prefix>.pickle in path, writing numeric arrays larger than min_bytes (including
+    those inside pandas objects) to separate .npy files so they can be memory-mapped on load.
+    Returns the name of the pickle file; on error all partially written files are removed.
+    """
+    fn = '%s.pickle' % prefix
+    npy_files = []
+
+    def persistent_id(o):
+        if isinstance(o, np.ndarray) and o.dtype != object and o.nbytes >= min_bytes:
+            npy_fn = '%s_%d.npy' % (prefix, len(npy_files))
+            np.save(os.path.join(path, npy_fn), o)
+            npy_files.append(npy_fn)
+            return npy_fn
+        return None
+
+    try:
+        with open(os.path.join(path, fn), 'wb') as f:
+            p = pickle.Pickler(f, 2)
+            p.persistent_id = persistent_id
+            p.dump(obj)
+
+    except Exception:
+        for rfn in [fn] + npy_files:
+            if os.path.exists(os.path.join(path, rfn)):
+                os.remove(os.path.join(path, rfn))
+        raise
+
+    return fn
+
+
+def load(path, fn):
+    """
+    Load an object saved with dump; arrays are memory-mapped read-only
+    """
+    def persistent_load(pid):
+        return np.load(os.path.join(path, pid), mmap_mode='r')
+
+    with open(os.path.join(path, fn), 'rb') as f:
+        u = pickle.Unpickler(f)
+        u.persistent_load = persistent_load
+        return u.load()
+
+
+class SharedRef(object):
+    """
+    Reference to an object in a SharedStore
+    """
+
+    def __init__(self, path, fn):
+        self.path = path
+        self.fn = fn
+
+    def __repr__(self):
+        return "SharedRef(%s)" % os.path.join(self.path, self.fn)
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, self.fn))
+
+    def load(self):
+        return load(self.path, self.fn)
+
+    def remove(self):
+        # The pickle and any .npy files written with it (see dump)
+        prefix = os.path.splitext(self.fn)[0]
+        for fn in glob.glob(os.path.join(self.path, '%s.*' % prefix)) + \
+                  glob.glob(os.path.join(self.path, '%s_*.npy' % prefix)):
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+
+
+class InlineRef(object):
+    """
+    Stands in for a SharedRef where the object is held directly, e.g. in saved results which
+    must outlive the shared store of the session
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __repr__(self):
+        return "InlineRef(%s)" % type(self.obj).__name__
+
+    def exists(self):
+        return True
+
+    def load(self):
+        return self.obj
+
+    def remove(self):
+        pass
+
+
+class SharedProxy(object):
+    """
+    Base for objects standing in for an object in a SharedStore, which is loaded on demand
+
+    The GUI owns the stored data; when the owning proxy is no longer referenced (the tool
+    has a new result, and it has dropped out of the result cache) the files are removed.
+    Engines that have already mapped the data are unaffected.
+    """
+
+    def __init__(self, ref):
+        self.ref = ref
+        self._obj = None
+        self._is_owner = False
+
+    def __getstate__(self):
+        # Copies (sent to engines, saved) are never the owner
+        state = self.__dict__.copy()
+        state['_obj'] = None
+        state['_is_owner'] = False
+        return state
+
+    def __del__(self):
+        if self._is_owner:
+            self.ref.remove()
+
+    def own(self):
+        self._is_owner = True
+
+    def load(self):
+        if self._obj is None:
+            self._obj = self.ref.load()
+        return self._obj
+
+
+class DataProxy(SharedProxy):
+    """
+    Lightweight stand-in for a data object in a SharedStore
+
+    Holds the type, shape, dtype(s), index and columns of the data, plus a short preview,
+    so it can be described (and matched against tool inputs) without loading the data. The
+    data itself is mapped from the store on load().
+    """
+
+    preview_rows = 10
+
+    def __init__(self, ref, obj):
+        super(DataProxy, self).__init__(ref)
+        self.proxy_type = type(obj)
+        self.shape = obj.shape
+        self.ndim = len(obj.shape)
+        self.dtype = obj.dtypes if isinstance(obj, pd.DataFrame) else obj.dtype
+        self.index = getattr(obj, 'index', None)
+        self.columns = getattr(obj, 'columns', None)
+        self.name = getattr(obj, 'name', None)
+        self.nbytes = data_size(obj)
+
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            self.preview = obj.iloc[:self.preview_rows].copy()
+        else:
+            self.preview = np.array(obj[:self.preview_rows])
+
+    def __repr__(self):
+        return "<DataProxy %s(%s)>" % (self.proxy_type.__name__, 'x'.join([str(s) for s in self.shape]))
+
+
+class SharedStore(object):
+    """
+    Host-local store of objects, shared between the GUI and engines via the filesystem
+
+    Objects are stored under their kernel variable name (e.g. _<interface>_<id>, as used for
+    the tool IO) plus a unique token, so a newly written version never replaces data that
+    is mapped elsewhere. Old versions are removed by the GUI once unused (see DataProxy);
+    on POSIX systems this leaves existing mappings intact.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            path = os.path.join(base, 'pathomx-%d' % os.getpid())
+        self.path = path
+
+    def put(self, name, obj):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:  # Created by another engine
+                pass
+
+        fn = dump(obj, self.path, '%s-%s' % (name, uuid.uuid4().hex))
+        return SharedRef(self.path, fn)
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def is_shareable(obj):
+    return isinstance(obj, (pd.DataFrame, pd.Series, np.ndarray)) and data_size(obj) >= SHARED_MIN_BYTES
+
+
+def _read_only_values(values):
+    v = values.view()
+    v.flags.writeable = False
+    return v
+
+
+def read_only(obj):
+    """
+    Return a read-only view of obj: a new DataFrame, Series or array sharing the data of the
+    original, which raises ValueError on modification in place. Anything that cannot be viewed
+    this way (mixed-type DataFrames, object arrays, other objects) is deep-copied instead.
+    """
+    if isinstance(obj, pd.DataFrame):
+        if len(set(obj.dtypes)) == 1 and obj.values.dtype != object:
+            # Index objects are mutable (names), so are copied; cheap, as the labels are shared
+            return pd.DataFrame(_read_only_values(obj.values), index=obj.index.copy(), columns=obj.columns.copy(), copy=False)
+
+    elif isinstance(obj, pd.Series):
+        if obj.dtype != object:
+            return pd.Series(_read_only_values(obj.values), index=obj.index.copy(), name=obj.name, copy=False)
+
+    elif isinstance(obj, np.ndarray):
+        if obj.dtype != object:
+            return _read_only_values(obj)
+
+    return deepcopy(obj)
+
+
+def is_read_only_error(e):
+    """
+    True if the exception was raised by modifying a read-only array (see read_only)
+    """
+    return isinstance(e, ValueError) and 'read-only' in str(e)
+
+
+def fingerprint(obj):
+    """
+    Return a hash of the content of obj (see utils.data_fingerprint); objects in the shared store
+    are identified by their file, which is unique to each stored version, so are never loaded
+    """
+    if isinstance(obj, SharedProxy):
+        return 'shared:%s' % obj.ref.fn
+    return data_fingerprint(obj)
+
+
+def resolve(obj):
+    """
+    Return the object a SharedRef or DataProxy refers to (or the object itself if neither)
+    """
+    if isinstance(obj, (SharedRef, DataProxy)):
+        return obj.load()
+    return obj
+
+
+def data_type(obj):
+    """
+    Return the type of the object, or of the data a DataProxy stands in for
+    """
+    if isinstance(obj, DataProxy):
+        return obj.proxy_type
+    return type(obj)
@@ -15,12 +15,13 @@ from collections import OrderedDict
 from pyqtconfig import ConfigManager, RECALCULATE_VIEW, RECALCULATE_ALL
 from . import utils
 from . import data
+from . import transport
 from . import displayobjects
 from .globals import styles, MATCH_EXACT, MATCH_CONTAINS, MATCH_START, MATCH_END, \
                     MATCH_REGEXP, MARKERS, LINESTYLES, FILLSTYLES, HATCHSTYLES, \
                     StyleDefinition, ClassMatchDefinition, notebook_queue, \
                     current_tools, current_tools_by_id, installed_plugin_names, current_datasets, \
-                    mono_fontFamily, custom_pyqtconfig_hooks
+                    mono_fontFamily, custom_pyqtconfig_hooks, settings
 
 import tempfile
 
@@ -42,7 +43,8 @@ from IPython.nbconvert.filters.markdown import markdown2html_mistune
 from IPython.core import display
 from IPython.qt.console.ansi_code_processor import QtAnsiCodeProcessor
 
-from .runqueue import STATUS_READY, STATUS_RUNNING, STATUS_COMPLETE, STATUS_ERROR, STATUS_BLOCKED
+from .runqueue import STATUS_READY, STATUS_RUNNING, STATUS_COMPLETE, STATUS_ERROR, STATUS_BLOCKED, \
+                      PRIORITY_NORMAL, PRIORITY_INTERACTIVE
 from .kernel_helpers import PathomxTool
 
 from PIL import Image
@@ -149,6 +151,17 @@ class KernelStatusWidget(QWidget):
             elif k.status == STATUS_BLOCKED:
                 p.setColor(w.backgroundRole(), QColor(0, 255, 0, 63))
 
+            if not k.is_warm:
+                # Still importing modules (see Queue.create_runners)
+                p.setColor(w.backgroundRole(), QColor(255, 165, 0, 127))
+                tip = tr('Kernel %d: warming up') % (i + 1)
+            else:
+                tip = tr('Kernel %d: ready') % (i + 1) if k.status == STATUS_READY else tr('Kernel %d: busy') % (i + 1)
+
+            if k.rss:
+                tip += ' (%d MB)' % (k.rss // (1024 * 1024))
+            w.setToolTip(tip)
+
             w.setPalette(p)
 
     def sizeHint(self):
@@ -1301,6 +1314,7 @@ class GenericApp(QObject):
     help_tab_html_filename = None
     status = pyqtSignal(str)
     progress = pyqtSignal(float)
+    progress_info = pyqtSignal(dict)  # progress, label and eta (see runqueue.Runner.check_progress)
     complete = pyqtSignal()
 
     deleted = pyqtSignal()
@@ -1322,6 +1336,11 @@ class GenericApp(QObject):
 
     language = 'python'  # Script/function language (determines loading IPython helpers)
 
+    # Variables returned from the tool code as views, in addition to the outputs and any figures or
+    # display objects (see kernel_helpers.pathomx_notebook_stop); anything else is left on the kernel.
+    # None returns any DataFrame or notebook aware object also, for tools running arbitrary code
+    view_vars = []
+
     def __init__(self, parent, name=None, code="", position=None, auto_focus=True, auto_consume_data=True, *args, **kwargs):
         super(GenericApp, self).__init__(parent)
 
@@ -1342,11 +1361,24 @@ class GenericApp(QObject):
         self._auto_consume_data = auto_consume_data
 
         self.current_data_on_kernels = set([])
+        # Expected runtime (seconds) from previous runs; None until run
+        self.runtime = None
+        # Cache key of the current result (see runqueue.ToolJob.result_key)
+        self.result_key = None
+        # Outputs available in the shared store, by interface
+        self.shared_refs = {}
 
         # Set this to true to auto-start a new calculation after current (block multi-runs)
         self._is_job_active = False
         self._queued_start = False
 
+        # Config changes are coalesced; a burst of edits (e.g. scrubbing a spinbox) fires
+        # once, after the interval has passed without further changes, with the latest config
+        self._autoconfig_signal = None
+        self._autoconfig_timer = QTimer()
+        self._autoconfig_timer.setSingleShot(True)
+        self._autoconfig_timer.timeout.connect(self.autoconfig_timeout)
+
         # Initiate logging
         self.log_viewer = QTextEdit()
         self.log_viewer.setReadOnly(True)
@@ -1520,22 +1552,26 @@ class GenericApp(QObject):
         if self._pause_analysis_flag:
             self.status.emit('paused')
             return False
-        self.generate()
-
-    def generate(self):
-        self.logger.info("Running tool %s" % self.name)
+        self.generate(priority=kwargs.get('priority', PRIORITY_NORMAL))
 
+    def get_global_varsi(self):
+        """
+        Return the global vars (rcParams, styles) passed to each tool in a job
+        """
         strip_rcParams = ['tk.pythoninspect', 'savefig.extension']
-        global_varsi = {
+        return {
             '_rcParams': {k: v for k, v in rcParams.items() if k not in strip_rcParams},
             '_styles': styles,
             '_pathomx_database_path': os.path.join(utils.scriptdir, 'database'),
         }
 
+    def generate(self, priority=PRIORITY_NORMAL, use_cache=True):
+        self.logger.info("Running tool %s" % self.name)
+
         self.status.emit('active')
         self.progress.emit(0.)
 
-        notebook_queue.add( ToolJob(self, global_varsi) )
+        notebook_queue.add( ToolJob(self, self.get_global_varsi(), use_cache=use_cache, priority=priority) )
 
 
     def _worker_result_callback(self, result):
@@ -1548,14 +1584,25 @@ class GenericApp(QObject):
             self.logger.debug("Execute complete: %s" % self.name)
             self.status.emit('done')
             varso = result['varso']
+            self._latest_generator_result = varso
 
             if 'styles' in varso:
                 global styles
                 styles = varso['styles']
 
             if 'kernel' in result:
-                # Only this kernel is now up to date
-                self.current_data_on_kernels = set([result['kernel']])
+                # Only this kernel is now up to date (None for cached results; on no kernel)
+                self.current_data_on_kernels = set([result['kernel']]) if result['kernel'] is not None else set([])
+
+            # References to the outputs in the shared store (see transport.SharedStore)
+            self.shared_refs = {k: v.ref for k, v in varso.items() if isinstance(v, transport.DataProxy)}
+
+            if 'runtime' in result:
+                # Smoothed runtime, used to weight the critical path when planning jobs
+                if self.runtime is None:
+                    self.runtime = result['runtime']
+                else:
+                    self.runtime = 0.5 * self.runtime + 0.5 * result['runtime']
 
         elif result['status'] == -1:
             self.logger.debug("Execute error: %s" % self.name)
@@ -1565,6 +1612,19 @@ class GenericApp(QObject):
 
         self.worker_cleanup(varso)
 
+    def _worker_cancelled_callback(self):
+        self.logger.info("Cancelled: %s" % self.name)
+        self.status.emit('cancelled')
+        self.progress.emit(1.)
+
+    def restore_result(self, key, varso):
+        """
+        Restore a previously calculated result (e.g. saved with the workflow) as if it had been run
+        """
+        self.result_key = key
+        notebook_queue.cache.put(key, varso, tag=id(self))
+        self._worker_result_callback({'status': 0, 'varso': varso, 'kernel': None})
+
     def worker_cleanup(self, varso):
         # Copy the data for the views here; or we're sending the same data to the get (main thread)
         # as to the prerender loop (seperate thread) without a lock
@@ -1606,7 +1666,7 @@ class GenericApp(QObject):
             }
 
         for k, v in kwargs.items():
-            if isinstance(v, Figure):
+            if isinstance(v, Figure) or isinstance(v, displayobjects.RenderedFigure):
                 if self.views.get_type(k) != IPyMplView:
                     self.views.addView(IPyMplView(self), k, color=FIGURE_COLOR)
                 result_dict[k] = {'fig': v}
@@ -1623,7 +1683,8 @@ class GenericApp(QObject):
 
                 result_dict[k] = {'html': v}
 
-            elif isinstance(v,pd.DataFrame):
+            elif issubclass(transport.data_type(v), pd.DataFrame):
+                # DataProxy is resolved when the view is shown
                 if self.views.get_type(k) != DataFrameWidget:
                     self.views.addView(DataFrameWidget(pd.DataFrame({}), parent=self), k, color=DATA_COLOR)
 
@@ -1636,11 +1697,11 @@ class GenericApp(QObject):
                 result_dict[k] = {'image': v}
 
             elif hasattr(v, '_repr_html_'):
-                # on IPython notebook aware objects to generate Html views
+                # on IPython notebook aware objects to generate Html views; rendered when shown
                 if self.views.get_type(k) != HTMLView:
                     self.views.addView(HTMLView(self), k, color=FIGURE_COLOR)
 
-                result_dict[k] = {'html': v._repr_html_()}
+                result_dict[k] = {'html': displayobjects.Html(v)}
 
         return result_dict
 
@@ -1660,6 +1721,8 @@ class GenericApp(QObject):
         self.config.reset()
         self.config.deleteLater()
         current_tools.remove(self)
+        # The data held on kernels is now stale (see runqueue.Runner.stale_vars)
+        self.current_data_on_kernels = set([])
 
         # Trigger notification for state change
         self.editorItem = None  # Remove reference to the GraphicsItem
@@ -1674,8 +1737,19 @@ class GenericApp(QObject):
         # self.parent().update_progress( id(self), progress)
 
     def autoconfig(self, signal):
+        # Recalculating everything covers a view update; keep the more thorough request
+        if self._autoconfig_signal != RECALCULATE_ALL:
+            self._autoconfig_signal = signal
+
+        # (Re)start the coalescing window
+        self._autoconfig_timer.start(int(settings.get('Runner/Coalesce_interval')))
+
+    def autoconfig_timeout(self):
+        signal, self._autoconfig_signal = self._autoconfig_signal, None
+
         if signal == RECALCULATE_ALL or self._latest_generator_result is None:
-            self.autogenerate()
+            # User edits run ahead of other work
+            self.autogenerate(priority=PRIORITY_INTERACTIVE)
 
         elif signal == RECALCULATE_VIEW:
             self.autoprerender(self._latest_generator_result)
@@ -1739,6 +1813,11 @@ class GenericApp(QObject):
         select_dataAction.triggered.connect(self.onRecalculate)
         t.addAction(select_dataAction)
 
+        select_dataAction = QAction(QIcon(os.path.join(utils.scriptdir, 'icons', 'cross.png')), tr('Cancel'), self.w)
+        select_dataAction.setStatusTip('Stop calculating this tool, and the tools that depend on it')
+        select_dataAction.triggered.connect(self.onCancel)
+        t.addAction(select_dataAction)
+
         self.pause_analysisAction = QAction(QIcon(os.path.join(utils.scriptdir, 'icons', 'control-pause.png')), tr('Pause automatic analysis'), self.w)
         self.pause_analysisAction.setStatusTip('Do not automatically refresh analysis when source data updates')
         self.pause_analysisAction.setCheckable(True)
@@ -1747,6 +1826,11 @@ class GenericApp(QObject):
         t.addAction(self.pause_analysisAction)
         self._pause_analysis_flag = self.default_pause_analysis
 
+        select_dataAction = QAction(QIcon(os.path.join(utils.scriptdir, 'icons', 'receipt-shred.png')), tr('Clear cached results'), self.w)
+        select_dataAction.setStatusTip('Discard cached results for this tool; the next calculation will run in full')
+        select_dataAction.triggered.connect(self.onClearCache)
+        t.addAction(select_dataAction)
+
         select_dataAction = QAction(QIcon(os.path.join(utils.scriptdir, 'icons', 'data-output.png')), tr('View resulting data…'), self.w)
         select_dataAction.setStatusTip('View resulting data output from this plugin')
         select_dataAction.triggered.connect(self.onViewDataOutput)
@@ -1949,7 +2033,16 @@ class GenericApp(QObject):
             cw.saveAsImage(sizedialog)
 
     def onRecalculate(self):
-        self.generate()  # Bypass
+        # Run everything again, rather than using cached results; e.g. to fetch remote data again
+        notebook_queue.cache.invalidate_tag(id(self))
+        self.generate(priority=PRIORITY_INTERACTIVE, use_cache=False)  # Bypass
+
+    def onCancel(self):
+        notebook_queue.cancel_tool(self)
+
+    def onClearCache(self):
+        notebook_queue.cache.invalidate_tag(id(self))
+        self.result_key = None
 
     def onBrowserNav(self, url):
         self.parent().onBrowserNav(url)
@@ -2006,7 +2099,7 @@ class ExportDataApp(IPythonApp):
         filename, _ = QFileDialog.getSaveFileName(self.w, self.export_description, '', self.export_filename_filter)
         if filename:
             self.config.set('filename', filename)
-            self.autogenerate()
+            self.autogenerate(priority=PRIORITY_INTERACTIVE)
 
 
 # Analysis/Visualisation view prototypes
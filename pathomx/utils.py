@@ -4,6 +4,12 @@ import sys
 import errno
 import csv
 import codecs
+import re
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 try:
     from cStringIO import StringIO
@@ -15,6 +21,11 @@ try:
 except ImportError:
     import xml.etree.ElementTree as et
 
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
 rdbu9 = [0, '#b2182b', '#d6604d', '#f4a582', '#fddbc7', '#cccccc', '#d1e5f0', '#92c5de', '#4393c3', '#2166ac']
 rdbu9c = [0, '#ffffff', '#000000', '#000000', '#000000', '#000000', '#000000', '#000000', '#ffffff', '#ffffff']
 category10 = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
@@ -145,6 +156,13 @@ def swap(ino, outo):
     return (outo, ino)
 
 
+def setting_bool(v):
+    # QSettings returns booleans as strings on some platforms; bool('false') is True
+    if isinstance(v, (str, type(u''))):
+        return v.lower() == 'true'
+    return bool(v)
+
+
 def nonull(stream):
     for line in stream:
         yield line.replace('\x00', '')
@@ -223,6 +241,161 @@ def mkdir_p(path):
             raise
 
 
+def data_size(o):
+    '''
+    Estimate the size in bytes of a data object; pandas objects and numpy arrays report
+    the size of their values (without copying), anything else falls back to sys.getsizeof
+    '''
+    if o is None:
+        return 0
+
+    if hasattr(o, 'memory_usage'):  # pandas DataFrame, Series
+        m = o.memory_usage()
+        return int(m.sum()) if hasattr(m, 'sum') else int(m)
+
+    if hasattr(o, 'nbytes'):  # numpy ndarray
+        return int(o.nbytes)
+
+    try:
+        return sys.getsizeof(o)
+    except TypeError:
+        return 0
+
+
+def data_fingerprint(o, h=None):
+    '''
+    Return a hash (hex digest) of the content of a data object; for numpy arrays and
+    pandas objects the underlying buffers are hashed directly, anything else is pickled
+    '''
+    import hashlib
+    import numpy as np
+
+    is_root = h is None
+    if is_root:
+        h = hashlib.sha1()
+
+    if o is None:
+        h.update(b'None')
+
+    elif hasattr(o, 'columns') and hasattr(o, 'index'):  # pandas DataFrame
+        h.update(b'DataFrame')
+        data_fingerprint(o.index, h)
+        data_fingerprint(o.columns, h)
+        if len(set(o.dtypes)) <= 1:
+            data_fingerprint(o.values, h)  # Single block; no copy
+        else:
+            for n in range(o.shape[1]):
+                data_fingerprint(o.iloc[:, n].values, h)
+
+    elif hasattr(o, 'index') and hasattr(o, 'values'):  # pandas Series
+        h.update(b'Series')
+        data_fingerprint(o.index, h)
+        data_fingerprint(o.values, h)
+
+    elif hasattr(o, 'names') and hasattr(o, 'values'):  # pandas Index, MultiIndex
+        h.update(('Index%s' % list(o.names)).encode('utf8'))
+        data_fingerprint(np.asarray(o), h)
+
+    elif isinstance(o, np.ndarray) and o.dtype != object:
+        h.update(('ndarray%s%s' % (o.dtype.str, o.shape)).encode('utf8'))
+        h.update(np.ascontiguousarray(o).reshape(-1).view(np.uint8))
+
+    else:
+        try:
+            h.update(pickle.dumps(o, 2))
+        except Exception:
+            h.update(repr(o).encode('utf8'))
+
+    if is_root:
+        return h.hexdigest()
+
+
+IMPORT_REGEXP = re.compile(r'^\s*(?:from\s+([\w\.]+)\s+import|import\s+([\w\., ]+))', re.MULTILINE)
+
+
+def find_imports(fn):
+    '''
+    Return the list of (absolute) modules imported by the Python script fn, in order; scripts that
+    cannot be parsed (e.g. for another Python version) are scanned for import lines instead
+    '''
+    import ast
+
+    with open(fn, 'rb') as f:
+        source = f.read().decode('utf-8', 'replace')
+
+    modules = []
+    try:
+        tree = ast.parse(source.encode('utf-8'), fn)
+
+    except SyntaxError:
+        for m in IMPORT_REGEXP.finditer(source):
+            if m.group(1):
+                modules.append(m.group(1))
+            else:
+                modules.extend([n.split()[0] for n in m.group(2).split(',') if n.strip()])
+
+    else:
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules.extend([a.name for a in node.names])
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                modules.append(node.module)
+
+    return [m for m in modules if not m.startswith('.')]
+
+
+def _meminfo(key):
+    # Linux only; value in bytes
+    with open('/proc/meminfo', 'r') as f:
+        for l in f:
+            if l.startswith('%s:' % key):
+                return int(l.split()[1]) * 1024
+    return None
+
+
+def total_memory():
+    '''
+    Return the total physical memory in bytes, or None if unknown
+    '''
+    if psutil is not None:
+        return psutil.virtual_memory().total
+
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def available_memory():
+    '''
+    Return the memory available for new processes in bytes, or None if unknown
+    '''
+    if psutil is not None:
+        return psutil.virtual_memory().available
+
+    try:
+        return _meminfo('MemAvailable')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def process_rss(pid):
+    '''
+    Return the resident set size (memory in use) of the process pid in bytes, or None if unknown
+    '''
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except Exception:
+            return None
+
+    try:
+        with open('/proc/%d/statm' % pid, 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
 # http://stackoverflow.com/questions/377017/test-if-executable-exists-in-python
 def which(program):
     import os
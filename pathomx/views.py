@@ -13,6 +13,8 @@ from collections import OrderedDict
 # Pathomx classes
 from . import utils
 from . import db
+from . import transport
+from . import displayobjects
 
 import numpy as np
 import pandas as pd
@@ -97,10 +99,11 @@ class ViewManager( QTabWidget ):
         self.data = dict() # Stores data from which figures are rendered
         self.views = {}
         
-        self._refresh_later = set() # Indexes of views to update at some future point
+        self._refresh_later = set() # Views to update when they are next shown
     
         self.source_data_updated.connect(self.onRefreshAll)
         self.style_updated.connect(self.onRefreshAll)
+        self.currentChanged.connect(self.onRefreshLater)
     
     # A few wrappers to 
     def addView(self, widget, name, color=None, createargs=[], focused=True, unfocus_on_refresh=False, **kwargs):
@@ -145,26 +148,35 @@ class ViewManager( QTabWidget ):
         else:
             return None
     
-    def onRefreshAll(self): #, to_refresh=None):
+    def onRefreshAll(self):
+        # Only the current view is generated now; rendering views (and loading the data
+        # for them) is expensive, so the others are generated when they are shown
+        self._refresh_later = set(self.widget(n) for n in range(self.count()))
+        self.refresh([self.currentWidget()])
+
+    def onRefreshLater(self, n=None):
+        w = self.currentWidget()
+        if w in self._refresh_later:
+            self.refresh([w])
+
+    def refresh(self, widgets):
         to_delete = []
         
-        #if to_refresh is None:
-        #    others = set( range(self.count()) )
-        #    others.discard(self.currentIndex())
-        #    self._refresh_later.update( others )
-        #    self.postponed_refresh.emit()
-        #    to_refresh = [self.currentIndex()]
-        
-        for n in range(self.count()): #to_refresh:
+        for w in widgets:
+            if w is None:
+                continue
+
+            self._refresh_later.discard(w)
+            n = self.indexOf(w)
 
-            if hasattr(self.widget(n),'autogenerate') and self.widget(n).autogenerate:
+            if hasattr(w,'autogenerate') and w.autogenerate:
                 try:
-                    self.widget(n).autogenerate()
+                    w.autogenerate()
                 except Exception as e:
                     logging.error(e)
                     # Failure; disable the tab or delete
                     if self._auto_delete_on_no_data:
-                        to_delete.append( self.widget(n) )
+                        to_delete.append( w )
                     else:
                         self.setTabEnabled( n, False)
                 else:
@@ -173,7 +185,7 @@ class ViewManager( QTabWidget ):
 
         # Do after so don't upset ordering on loop
         for w in to_delete:
-            k = self.views.keys()[ list( self.views.values() ).index( w ) ]
+            k = list(self.views.keys())[ list( self.views.values() ).index( w ) ]
             del self.views[k]
             w.deleteLater()
             self.removeTab( self.indexOf(w) )
@@ -181,10 +193,6 @@ class ViewManager( QTabWidget ):
 
         self.updated.emit()
         
-    #def onRefreshLater(self):
-    #    self.onRefreshAll( to_refresh=self._refresh_later )
-    #    self._refresh_later.clear()
-        
     def addTab(self, widget, name, **kwargs):
         """
         Overridden to redirect addTab calls to addView method. Do not use.
@@ -225,7 +233,8 @@ class BaseView(object):
         return self.vm.data[ self.name ] 
         
     def autogenerate(self):
-        self.generate( **self.vm.data[ self.name ] )
+        # Data may be held as proxies to the shared store; load it now it is needed
+        self.generate( **{k: transport.resolve(v) for k, v in self.vm.data[ self.name ].items()} )
         
     def _build_entity_cmp(self,s,e,l):
         return e is None
@@ -840,10 +849,20 @@ class MplView(FigureCanvas, BaseView):
  
 class IPyMplView(MplView):
     """Ultimately, this is a QWidget (as well as a FigureCanvasAgg, etc.)."""
+
+    _rendered = None
+
     def generate(self, fig=None):
 
         if fig is None:
             return
+
+        if isinstance(fig, displayobjects.RenderedFigure):
+            # Show the image rendered on the engine; the Figure is only loaded for interaction
+            self._rendered = fig
+            fig = fig.placeholder()
+        else:
+            self._rendered = None
         
         fc = fig.get_facecolor()
         if fc == (1, 1, 1, 0): # Default non-background
@@ -874,9 +893,10 @@ class IPyMplView(MplView):
 
         boundsl = []
         for i, a in enumerate(self.fig.get_axes()):
-            xmin, xmax, ymin, ymax = lims[i]
             bounds = (a.get_xbound(), a.get_ybound())
-            if self._current_axis_bounds and self._current_axis_bounds[i] == bounds:
+            if self._current_axis_bounds and i < len(lims) and i < len(self._current_axis_bounds) and \
+               self._current_axis_bounds[i] == bounds:
+                    xmin, xmax, ymin, ymax = lims[i]
                     a.set_xlim((xmin, xmax))
                     a.set_ylim((ymin, ymax))
                     a.set_position(pos[i], 'active')
@@ -895,6 +915,31 @@ class IPyMplView(MplView):
 
         self.is_blank = False
 
+    def load_figure(self):
+        """
+        Replace a rendered figure with the Figure it was rendered from
+        """
+        if self._rendered is None:
+            return
+
+        rendered, self._rendered = self._rendered, None
+        self._current_axis_bounds = None  # Don't apply the limits of the placeholder
+        try:
+            fig = rendered.load()
+        except Exception as e:
+            logging.warning("Could not load figure (showing the rendered image only): %s" % e)
+            return
+
+        self.generate(fig)
+
+    def mousePressEvent(self, e):
+        self.load_figure()
+        super(IPyMplView, self).mousePressEvent(e)
+
+    def saveAsImage(self, settings):
+        self.load_figure()
+        super(IPyMplView, self).saveAsImage(settings)
+
 class DataFrameModel(QAbstractTableModel):
     """ data model for a DataFrame class """
     def __init__(self):
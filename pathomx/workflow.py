@@ -0,0 +1,64 @@
+from __future__ import unicode_literals
+import logging
+
+try:
+    import xml.etree.cElementTree as et
+except ImportError:
+    import xml.etree.ElementTree as et
+
+from .globals import app_launchers
+
+# Loading of workflow (.mpf) files; shared by the GUI (MainWindow.openWorkflow) and the batch runner
+
+
+def parse(fn):
+    """
+    Return the root element of the workflow file fn
+    """
+    return et.parse(fn).getroot()
+
+
+def create_tools(workflow, launch):
+    """
+    Create the tools of the workflow, then restore their config and the links between them
+
+    Each tool is created by calling launch(launcher, xapp, code=code, name=name) where launcher
+    is the tool class and xapp the tool's XML element. Returns a dict of (saved) tool id: tool.
+    """
+    appref = {}
+    logging.info("...Loading apps.")
+    for xapp in workflow.findall('App'):
+        # FIXME: This does not work with multiple launchers/plugin - define as plugin.class?
+        # Check plugins loaded etc.
+        logging.info(('- %s' % xapp.find('Name').text))
+
+        xcode = xapp.find('Code')
+        if xcode is not None:
+            code = xcode.text
+        else:
+            code = ""
+
+        launcher = app_launchers["%s.%s" % (xapp.find("Plugin").text, xapp.find("Launcher").text)]
+        app = launch(launcher, xapp, code=code, name=xapp.find('Name').text)
+        appref[xapp.get('id')] = app
+
+        app.config.setXMLConfig(xapp)
+
+    logging.info("...Linking objects.")
+    # Now build the links between objects; we need to force these as data is not present
+    for xapp in workflow.findall('App'):
+        app = appref[xapp.get('id')]
+
+        for idef in xapp.findall('DataInputs/Input'):
+            source_app = appref[idef.get('manager')]
+            source = idef.get('interface')
+            if source in source_app.legacy_outputs.keys():
+                source = source_app.legacy_outputs[source]
+
+            sink = idef.get('id')
+            if sink in app.legacy_inputs.keys():
+                sink = app.legacy_inputs[sink]
+
+            app.data._consume_action(source_app.data, source, sink)
+
+    return appref
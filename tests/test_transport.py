@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from pathomx import transport
+
+
+class TestFingerprint(unittest.TestCase):
+    """Unit tests for transport.fingerprint()"""
+
+    def setUp(self):
+        self.store = transport.SharedStore(tempfile.mkdtemp())
+        self.df = pd.DataFrame(np.arange(12, dtype=float).reshape(3, 4))
+
+    def tearDown(self):
+        shutil.rmtree(self.store.path, ignore_errors=True)
+
+    def test_data(self):
+        """Equal data gives equal fingerprints"""
+        self.assertEqual(transport.fingerprint(self.df), transport.fingerprint(self.df.copy()))
+        self.assertNotEqual(transport.fingerprint(self.df), transport.fingerprint(self.df + 1))
+
+    def test_dataframe_proxy(self):
+        """A DataFrame proxy is fingerprinted by its stored version, without loading"""
+        proxy = transport.DataProxy(self.store.put('_df', self.df), self.df)
+        self.assertEqual(transport.fingerprint(proxy), transport.fingerprint(proxy))
+
+        other = transport.DataProxy(self.store.put('_df', self.df), self.df)
+        self.assertNotEqual(transport.fingerprint(proxy), transport.fingerprint(other))
+
+    def test_series_proxy(self):
+        """A Series proxy is fingerprinted as for a DataFrame proxy"""
+        s = self.df.iloc[:, 0]
+        proxy = transport.DataProxy(self.store.put('_s', s), s)
+        self.assertTrue(transport.fingerprint(proxy))
+
+
+if __name__ == "__main__":
+    unittest.main()